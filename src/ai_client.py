@@ -1,16 +1,26 @@
 import os
+import re
+import json
+import hashlib
 import logging
 import asyncio
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List, Optional
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# thread_id в невалидном JSON ответа слинга (резервный разбор)
+_THREAD_ID_RE = re.compile(r'"thread_id":\s*(\d+)')
+
 
 class AIClient:
+    RESPONSE_CACHE_TTL_DAYS = 7  # Сколько дней хранится ответ LLM на одинаковый запрос
+    STREAM_IDLE_TIMEOUT = 20.0  # Сколько секунд ждем очередную часть потокового ответа
+    STREAM_TIMEOUT = 60.0  # Сколько секунд в сумме ждем части потокового ответа (без обработки у вызывающего кода)
+
     def __init__(self, db):
         self.api_key = os.getenv("OPENROUTER_API_KEY")
         if not self.api_key:
@@ -27,12 +37,54 @@ class AIClient:
         self.db = db
         self.models: Dict[str, str] = self.db.get_all_models()
 
-    async def send_request_with_retry(self, message: str, model_key: str = None, max_retries: int = 2) -> str:
-        """Отправляет запрос с повторными попытками"""
+    @staticmethod
+    def _build_messages(message: str, cached_prefix: Optional[str] = None) -> List[Dict]:
+        """Сообщения запроса; неизменная часть промпта (cached_prefix) помечается для кэша промптов провайдера"""
+        if not cached_prefix:
+            return [{"role": "user", "content": message}]
+        return [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": cached_prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": message},
+            ]
+        }]
+
+    @staticmethod
+    def _response_cache_key(message: str, model_key: Optional[str], json_mode: bool,
+                            cached_prefix: Optional[str]) -> str:
+        """Ключ кэша ответов: хэш модели, режима и полного текста запроса"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (model_key or '', '1' if json_mode else '0', cached_prefix or '', message):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    async def send_request_with_retry(self, message: str, model_key: str = None, max_retries: int = 2,
+                                      json_mode: bool = False, cached_prefix: Optional[str] = None,
+                                      use_cache: bool = False, meta: Optional[Dict] = None) -> str:
+        """Отправляет запрос с повторными попытками.
+
+        use_cache - вернуть сохраненный ответ на такой же запрос (не старше RESPONSE_CACHE_TTL_DAYS)
+        без обращения к API и сохранить новый ответ
+        meta - сюда записывается модель, которая ответила (meta['model']); при ответе из кэша не заполняется
+        """
+        cache_key = None
+        if use_cache:
+            cache_key = self._response_cache_key(message, model_key, json_mode, cached_prefix)
+            cached = await self.db.run(self.db.get_cached_llm_response, cache_key, self.RESPONSE_CACHE_TTL_DAYS)
+            if cached is not None:
+                logger.info(f"💾 Ответ LLM взят из кэша. Длина: {len(cached)} символов")
+                return cached
+
         last_error = None
         for attempt in range(max_retries):
             try:
-                return await self.send_request(message, model_key)
+                response = await self.send_request(message, model_key, json_mode=json_mode,
+                                                   cached_prefix=cached_prefix, meta=meta)
+                if cache_key and response:
+                    await self.db.run(self.db.save_cached_llm_response, cache_key, response)
+                return response
             except asyncio.TimeoutError:
                 logger.warning(f"⏰ Таймаут при попытке {attempt + 1}/{max_retries}")
                 last_error = "Timeout"
@@ -48,48 +100,116 @@ class AIClient:
         logger.error(error_msg)
         raise Exception(error_msg)
 
-    async def send_request(self, message: str, model_key: str = None) -> str:
-        """Отправляет асинхронный запрос к AI"""
-        logger.info(f"📨 Отправка запроса к LLM. Длина: {len(message)} символов")
+    async def send_request(self, message: str, model_key: str = None, json_mode: bool = False,
+                           cached_prefix: Optional[str] = None, meta: Optional[Dict] = None) -> str:
+        """Отправляет асинхронный запрос к AI (json_mode - просит модель вернуть строгий JSON без обрамления).
+
+        cached_prefix - неизменное начало промпта, идет перед message и кэшируется провайдером
+        (повторы и переключение на запасные модели не кодируют его заново)
+        meta - сюда записывается модель, которая ответила (meta['model'])
+        """
+        logger.info(f"📨 Отправка запроса к LLM. Длина: {len(cached_prefix or '') + len(message)} символов")
+
+        # Повторы всего запроса делает send_request_with_retry, здесь - один проход по моделям
+        current_model_key, completion = await self._create_completion(message, model_key, json_mode, cached_prefix)
+        if meta is not None:
+            meta['model'] = self.models.get(current_model_key)
+
+        response = completion.choices[0].message.content
+        logger.info(f"✅ Получен ответ от LLM. Длина: {len(response)} символов")
+        return response
+
+    async def send_request_stream(self, message: str, model_key: str = None, json_mode: bool = False,
+                                  cached_prefix: Optional[str] = None, max_retries: int = 2,
+                                  meta: Optional[Dict] = None) -> AsyncIterator[str]:
+        """Отправляет запрос к AI в режиме стриминга и отдает текст ответа по мере генерации.
+
+        На другую модель (и к повтору) переходим только если модель не начала отвечать;
+        ожидание каждой части ограничено STREAM_IDLE_TIMEOUT, все ожидание в сумме - STREAM_TIMEOUT секундами.
+        meta - сюда записывается модель, которая отвечает (meta['model']), до первой части ответа
+        """
+        logger.info(f"📨 Отправка потокового запроса к LLM. Длина: {len(cached_prefix or '') + len(message)} символов")
+
+        current_model_key, stream = await self._create_completion(
+            message, model_key, json_mode, cached_prefix, max_retries=max_retries, stream=True
+        )
+        if meta is not None:
+            meta['model'] = self.models.get(current_model_key)
 
+        received = 0
+        waited = 0.0  # Сколько секунд ждали части ответа
+        loop = asyncio.get_running_loop()
+        chunks = aiter(stream)
+        try:
+            while True:
+                # Считаем только ожидание частей: пока генератор приостановлен на yield,
+                # вызывающий код обрабатывает часть, и это время в таймауты не входит
+                started = loop.time()
+                async with asyncio.timeout(min(self.STREAM_IDLE_TIMEOUT, self.STREAM_TIMEOUT - waited)):
+                    chunk = await anext(chunks, None)
+                waited += loop.time() - started
+                if chunk is None:
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text = chunk.choices[0].delta.content
+                    received += len(text)
+                    yield text
+        except TimeoutError:
+            logger.warning(f"⏰ Потоковый ответ модели {current_model_key} прерван по таймауту "
+                           f"(ожидание {waited + loop.time() - started:.1f} сек., получено {received} символов)")
+            raise
+        finally:
+            await stream.close()
+        logger.info(f"✅ Получен потоковый ответ от LLM. Длина: {received} символов")
+
+    def _models_to_try(self, model_key: Optional[str]) -> List[str]:
+        """Ключи моделей в порядке попыток: указанная (или первая доступная), затем остальные"""
         if not self.models:
             raise Exception("❌ Нет доступных AI моделей")
-
-        # Если модель не указана, используем первую доступную
         if model_key is None:
-            model_key = list(self.models.keys())[0]
+            model_key = next(iter(self.models))
+        return [model_key] + [m for m in self.models if m != model_key]
 
-        # Пробуем указанную модель сначала
-        models_to_try = [model_key] + [m for m in self.models.keys() if m != model_key]
+    async def _create_completion(self, message: str, model_key: Optional[str], json_mode: bool,
+                                 cached_prefix: Optional[str], max_retries: int = 1, **params):
+        """Запрос к первой ответившей модели: (ключ модели, ответ API).
 
-        last_error = None
-        for current_model_key in models_to_try:
-            try:
-                model = self.models[current_model_key]
-                logger.info(f"🔄 Используется модель: {current_model_key}")
-
-                # Асинхронный вызов с таймаутом
-                completion = await asyncio.wait_for(
-                    self.client.chat.completions.create(
-                        model=model,
-                        messages=[{"role": "user", "content": message}],
-                        max_tokens=2000
-                    ),
-                    timeout=25.0  # Таймаут 25 секунд на запрос
-                )
-
-                response = completion.choices[0].message.content
-                logger.info(f"✅ Получен ответ от LLM. Длина: {len(response)} символов")
-                return response
+        Модели перебираются по очереди; если не ответила ни одна, проход повторяется
+        (до max_retries раз) с паузой 1, 2, 4... сек.
+        """
+        # OpenRouter игнорирует response_format у моделей, которые его не поддерживают
+        extra_params = {"response_format": {"type": "json_object"}} if json_mode else {}
+        messages = self._build_messages(message, cached_prefix)
 
-            except asyncio.TimeoutError:
-                logger.warning(f"⏰ Таймаут при использовании модели {current_model_key}")
-                last_error = "Timeout"
-                continue
-            except Exception as e:
-                logger.warning(f"❌ Модель {current_model_key} недоступна: {e}")
-                last_error = e
-                continue
+        last_error = None
+        for attempt in range(max_retries):
+            if attempt:
+                logger.warning(f"🔄 Попытка {attempt + 1}/{max_retries}: все модели недоступны, повторяем")
+                await asyncio.sleep(2 ** (attempt - 1))
+            for current_model_key in self._models_to_try(model_key):
+                try:
+                    model = self.models[current_model_key]
+                    logger.info(f"🔄 Используется модель: {current_model_key}")
+
+                    # Асинхронный вызов с таймаутом (для стриминга - на начало ответа)
+                    completion = await asyncio.wait_for(
+                        self.client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=2000,
+                            **extra_params,
+                            **params
+                        ),
+                        timeout=25.0  # Таймаут 25 секунд на запрос
+                    )
+                    return current_model_key, completion
+
+                except asyncio.TimeoutError:
+                    logger.warning(f"⏰ Таймаут при использовании модели {current_model_key}")
+                    last_error = "Timeout"
+                except Exception as e:
+                    logger.warning(f"❌ Модель {current_model_key} недоступна: {e}")
+                    last_error = e
 
         error_msg = f"❌ Все AI модели недоступны. Последняя ошибка: {str(last_error)}"
         logger.error(error_msg)
@@ -97,10 +217,12 @@ class AIClient:
 
     # === Базовые AI-схемы ===
 
-    async def classify_message_schema_b(self, message: str, active_threads: List[Dict] = None) -> Dict:
+    async def classify_message_schema_b(self, message: str, active_threads: List[Dict] = None,
+                                        meta: Optional[Dict] = None) -> Dict:
         """
         Схема Б: Классификация нового сообщения
         Определяет, является ли сообщение 'goal' или 'blocker'
+        meta - сюда записывается модель, которая ответила (meta['model'])
         """
         system_prompt = """
 Ты - классификатор сообщений для IT-сообщества. 
@@ -133,7 +255,7 @@ class AIClient:
 """
 
         try:
-            response = await self.send_request_with_json(system_prompt + user_prompt)
+            response = await self.send_request_with_json(system_prompt + user_prompt, meta=meta)
             return self._parse_classification_response(response)
         except Exception as e:
             logger.error(f"❌ Ошибка классификации сообщения: {e}")
@@ -166,12 +288,13 @@ class AIClient:
 """
 
         # Формируем список активных тредов для контекста
-        threads_context = ""
+        threads_parts = []
         for thread in active_threads:
-            threads_context += f"\nТред {thread['thread_id']} ({thread['classification_id']}): {thread['title']}"
+            threads_parts.append(f"\nТред {thread['thread_id']} ({thread['classification_id']}): {thread['title']}")
             if thread['messages']:
                 recent_messages = thread['messages'][-3:]  # Последние 3 сообщения
-                threads_context += f"\nПоследние сообщения: {' | '.join(recent_messages)}"
+                threads_parts.append(f"\nПоследние сообщения: {' | '.join(recent_messages)}")
+        threads_context = "".join(threads_parts)
 
         user_prompt = f"""
 Активные треды:{threads_context}
@@ -191,18 +314,19 @@ class AIClient:
 
     # === Вспомогательные методы ===
 
-    async def send_request_with_json(self, prompt: str, model_key: str = None) -> str:
+    async def send_request_with_json(self, prompt: str, model_key: str = None, meta: Optional[Dict] = None) -> str:
         """Отправляет запрос с ожиданием JSON ответа"""
         response = await self.send_request_with_retry(
             prompt + "\n\nВерни ответ ТОЛЬКО в формате JSON, без дополнительного текста.",
-            model_key
+            model_key,
+            json_mode=True,
+            meta=meta
         )
         return response
 
     def _parse_classification_response(self, response: str) -> Dict:
         """Парсит ответ классификации"""
         try:
-            import json
             # Пытаемся распарсить JSON
             data = json.loads(response)
             return {
@@ -229,9 +353,6 @@ class AIClient:
     def _parse_sling_response(self, response: str) -> Dict:
         """Парсит ответ семантического слинга"""
         try:
-            import json
-            import re
-
             # Пытаемся распарсить JSON
             data = json.loads(response)
             return {
@@ -243,7 +364,7 @@ class AIClient:
         except json.JSONDecodeError:
             # Резервный парсинг
             if '"related": true' in response:
-                thread_id_match = re.search(r'"thread_id":\s*(\d+)', response)
+                thread_id_match = _THREAD_ID_RE.search(response)
                 thread_id = int(thread_id_match.group(1)) if thread_id_match else None
                 return {
                     "related": True,
@@ -1,14 +1,18 @@
 import os
 import sqlite3
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 
 class Database:
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, max_workers: int = 4):
         # Определяем путь автоматически
         if db_path is None:
             # Если запущено в Docker - используем /app/data
@@ -21,15 +25,45 @@ class Database:
                 db_path = os.path.join(project_root, "data", "database.db")
 
         self.db_path = db_path
+        # Соединение с БД у каждого потока свое и переиспользуется между вызовами
+        self._local = threading.local()
+        # Пул потоков для вызовов из async-кода: число потоков, а значит и открытых соединений, ограничено
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
         # Создаем директорию для данных если её нет
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         logger.info(f"Используется база данных: {self.db_path}")
         self._init_db()
 
+    def run(self, func, *args, **kwargs) -> asyncio.Future:
+        """Выполняет синхронный метод БД в пуле потоков БД, не блокируя event loop.
+
+        Вызов отправляется в пул сразу; результат - awaitable: `await db.run(db.get_source_topics)`
+        """
+        return asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def close(self):
+        """Останавливает пул потоков БД"""
+        self._executor.shutdown(wait=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока (создает при первом обращении).
+
+        Используется как `with self._connect() as conn:` - блок with управляет транзакцией,
+        а само соединение остается открытым для следующих вызовов из этого потока
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            # WAL позволяет читать параллельно с записью из других потоков
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
     def _init_db(self):
         """Инициализация базы данных и создание таблиц"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
 
                 # Таблица для AI моделей
@@ -94,11 +128,33 @@ class Database:
                     )
                 ''')
 
+                # Кэш результатов AI-классификации (ключ - хэш нормализованного текста)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS classification_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        classification TEXT NOT NULL,
+                        title TEXT,
+                        confidence REAL,
+                        model_version TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # Кэш ответов LLM на одинаковые запросы (ключ - хэш модели и текста промпта)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS llm_response_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        response TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
                 # Создаем индексы для производительности
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread_id ON chat_messages(thread_id)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_classification ON chat_messages(classification_id)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON chat_messages(created_at)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_processed ON chat_messages(processed)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_topic_processed ON chat_messages(topic_id, processed, created_at)')
 
                 conn.commit()
                 logger.info("База данных инициализирована с новыми таблицами")
@@ -109,7 +165,7 @@ class Database:
     def add_source_topic(self, topic_id: int, topic_name: str = None) -> bool:
         """Добавляет топик-источник для парсинга"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT OR REPLACE INTO source_topics (topic_id, topic_name) VALUES (?, ?)",
@@ -125,7 +181,7 @@ class Database:
     def remove_source_topic(self, topic_id: int) -> bool:
         """Удаляет топик-источник"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM source_topics WHERE topic_id = ?", (topic_id,))
                 conn.commit()
@@ -140,7 +196,7 @@ class Database:
     def get_source_topics(self) -> List[Dict]:
         """Получает список всех топиков-источников"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT topic_id, topic_name FROM source_topics ORDER BY topic_id")
                 rows = cursor.fetchall()
@@ -154,7 +210,7 @@ class Database:
     def set_system_topic(self, topic_type: str, topic_id: int, topic_name: str = None) -> bool:
         """Устанавливает системный топик (announce или digest)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     """INSERT OR REPLACE INTO system_topics 
@@ -172,7 +228,7 @@ class Database:
     def get_system_topic(self, topic_type: str) -> Optional[Dict]:
         """Получает системный топик по типу"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "SELECT topic_type, topic_id, topic_name FROM system_topics WHERE topic_type = ?",
@@ -192,35 +248,66 @@ class Database:
 
     # === Методы для сообщений ===
 
+    @staticmethod
+    def _message_row(message_data: Dict) -> tuple:
+        """Приводит словарь сообщения к кортежу значений для INSERT"""
+        return (
+            message_data.get('message_id'),
+            message_data.get('topic_id'),
+            message_data.get('thread_id'),
+            message_data.get('parent_message_id'),
+            message_data.get('classification_id'),
+            message_data.get('message_text'),
+            message_data.get('created_at') or datetime.now(),
+            message_data.get('processed') or False
+        )
+
     def save_message(self, message_data: Dict) -> int:
         """Сохраняет сообщение в базу"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT OR REPLACE INTO chat_messages 
+                    INSERT OR REPLACE INTO chat_messages
                     (message_id, topic_id, thread_id, parent_message_id, classification_id, message_text, created_at, processed)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    message_data.get('message_id'),
-                    message_data.get('topic_id'),
-                    message_data.get('thread_id'),
-                    message_data.get('parent_message_id'),
-                    message_data.get('classification_id'),
-                    message_data.get('message_text'),
-                    message_data.get('created_at') or datetime.now(),
-                    message_data.get('processed') or False
-                ))
+                ''', self._message_row(message_data))
                 conn.commit()
                 return cursor.lastrowid
         except Exception as e:
             logger.error(f"Ошибка сохранения сообщения: {e}")
             return 0
 
+    def save_messages(self, messages: List[Dict]) -> int:
+        """Сохраняет пачку сообщений одной транзакцией, возвращает количество сохраненных.
+
+        Если пачка не записалась, сообщения сохраняются по одному - теряются только ошибочные
+        """
+        if not messages:
+            return 0
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO chat_messages
+                    (message_id, topic_id, thread_id, parent_message_id, classification_id, message_text, created_at, processed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [self._message_row(message_data) for message_data in messages])
+                conn.commit()
+                return len(messages)
+        except Exception as e:
+            logger.warning(f"Ошибка пакетного сохранения {len(messages)} сообщений "
+                           f"(ID {messages[0].get('message_id')}-{messages[-1].get('message_id')}): {e}; "
+                           f"сохраняем по одному")
+        saved = sum(1 for message_data in messages if self.save_message(message_data))
+        if saved < len(messages):
+            logger.error(f"Не сохранено сообщений из пачки: {len(messages) - saved} из {len(messages)}")
+        return saved
+
     def update_message_text(self, message_id: int, new_text: str) -> bool:
         """Обновляет текст сообщения по ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "UPDATE chat_messages SET message_text = ? WHERE id = ?",
@@ -235,7 +322,7 @@ class Database:
     def update_telegram_message_id(self, message_obj_id: int, telegram_message_id: int) -> bool:
         """Обновляет telegram message_id для записи в БД"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "UPDATE chat_messages SET message_id = ? WHERE id = ?",
@@ -250,7 +337,7 @@ class Database:
     def get_message_by_id(self, message_id: int) -> Optional[Dict]:
         """Получает сообщение по ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM chat_messages WHERE id = ?
@@ -267,7 +354,7 @@ class Database:
     def get_messages_for_period(self, days: int = 7) -> List[Dict]:
         """Получает сообщения за указанный период"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM chat_messages 
@@ -282,10 +369,27 @@ class Database:
             logger.error(f"Ошибка получения сообщений: {e}")
             return []
 
+    def get_classification_counts(self, days: int = 30) -> tuple:
+        """Одним проходом считает (сообщений за период, необработанных сообщений)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT
+                        COALESCE(SUM(created_at >= datetime('now', ?)), 0),
+                        COALESCE(SUM(processed = FALSE), 0)
+                    FROM chat_messages
+                ''', (f'-{days} days',))
+                total, unprocessed = cursor.fetchone()
+                return total, unprocessed
+        except Exception as e:
+            logger.error(f"Ошибка подсчета сообщений: {e}")
+            return 0, 0
+
     def get_messages_by_thread(self, thread_id: int) -> List[Dict]:
         """Получает все сообщения треда"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM chat_messages 
@@ -303,7 +407,7 @@ class Database:
     def cleanup_old_messages(self, days: int = 7) -> int:
         """Удаляет сообщения старше указанного количества дней"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     DELETE FROM chat_messages 
@@ -326,7 +430,7 @@ class Database:
     def create_thread(self, title: str, classification_id: str) -> int:
         """Создает новый тред и возвращает его ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO message_threads (title, classification_id) VALUES (?, ?)",
@@ -340,10 +444,31 @@ class Database:
             logger.error(f"Ошибка создания треда: {e}")
             return -1
 
+    def create_threads_bulk(self, threads: List[tuple]) -> List[int]:
+        """Создает несколько тредов (title, classification_id) одной транзакцией и возвращает их ID по порядку"""
+        if not threads:
+            return []
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                thread_ids = []
+                for title, classification_id in threads:
+                    cursor.execute(
+                        "INSERT INTO message_threads (title, classification_id) VALUES (?, ?)",
+                        (title, classification_id)
+                    )
+                    thread_ids.append(cursor.lastrowid)
+                conn.commit()
+                logger.info(f"Создано новых тредов: {len(thread_ids)}")
+                return thread_ids
+        except Exception as e:
+            logger.error(f"Ошибка создания тредов: {e}")
+            return []
+
     def get_active_threads(self) -> List[Dict]:
         """Получает активные треды"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM message_threads 
@@ -363,7 +488,7 @@ class Database:
     def get_thread_by_id(self, thread_id: int) -> Optional[Dict]:
         """Получает тред по ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM message_threads WHERE thread_id = ?
@@ -377,10 +502,28 @@ class Database:
             logger.error(f"Ошибка получения треда: {e}")
             return None
 
+    def get_threads_by_ids(self, thread_ids) -> List[Dict]:
+        """Получает треды по списку ID одним запросом"""
+        thread_ids = list(thread_ids)
+        if not thread_ids:
+            return []
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(thread_ids))
+                cursor.execute(f'''
+                    SELECT * FROM message_threads WHERE thread_id IN ({placeholders})
+                ''', thread_ids)
+                columns = [description[0] for description in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения тредов: {e}")
+            return []
+
     def update_message_thread(self, message_id: int, thread_id: int, classification_id: str = None) -> bool:
         """Обновляет тред и классификацию для сообщения"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 if classification_id:
                     cursor.execute('''
@@ -400,10 +543,32 @@ class Database:
             logger.error(f"Ошибка обновления треда сообщения: {e}")
             return False
 
+    def update_message_threads_bulk(self, rows: List[tuple]) -> int:
+        """Обновляет тред и классификацию для нескольких сообщений одной транзакцией.
+
+        rows - кортежи (message_id, thread_id, classification_id); если classification_id равен None,
+        классификация сообщения не меняется (как в update_message_thread)
+        """
+        if not rows:
+            return 0
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    UPDATE chat_messages 
+                    SET thread_id = ?, classification_id = COALESCE(?, classification_id), processed = TRUE
+                    WHERE message_id = ?
+                ''', [(thread_id, classification_id, message_id) for message_id, thread_id, classification_id in rows])
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка пакетного обновления тредов сообщений: {e}")
+            return 0
+
     def get_unprocessed_messages(self) -> List[Dict]:
         """Получает необработанные сообщения"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM chat_messages 
@@ -417,26 +582,104 @@ class Database:
             logger.error(f"Ошибка получения необработанных сообщений: {e}")
             return []
 
-    def get_active_threads_with_messages(self, days: int = 7) -> List[Dict]:
-        """Получает активные треды с сообщениями за период"""
+    def iter_unprocessed_by_topic(self, chunk_size: int = 500) -> Iterator[Tuple[Optional[int], List[Dict]]]:
+        """Потоково отдает необработанные сообщения по топикам: (topic_id, порция до chunk_size сообщений).
+
+        Топики идут один за другим, внутри топика - в порядке создания
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        mt.thread_id,
-                        mt.title,
-                        mt.classification_id,
-                        mt.created_at,
-                        COUNT(cm.id) as message_count,
-                        GROUP_CONCAT(cm.message_text, ' ||| ') as messages
-                    FROM message_threads mt
-                    LEFT JOIN chat_messages cm ON mt.thread_id = cm.thread_id 
-                        AND cm.created_at >= datetime('now', ?)
-                    WHERE mt.is_active = TRUE
-                    GROUP BY mt.thread_id
-                    ORDER BY mt.created_at DESC
-                ''', (f'-{days} days',))
+                cursor.execute('SELECT DISTINCT topic_id FROM chat_messages WHERE processed = FALSE')
+                topic_ids = [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения топиков с необработанными сообщениями: {e}")
+            return
+
+        for topic_id in topic_ids:
+            last_key = None
+            while True:
+                rows = self._fetch_unprocessed_chunk(topic_id, last_key, chunk_size)
+                if not rows:
+                    break
+                yield topic_id, rows
+                if len(rows) < chunk_size:
+                    break
+                last_key = (rows[-1]['created_at'], rows[-1]['id'])
+
+    def _fetch_unprocessed_chunk(self, topic_id: Optional[int], after: Optional[tuple], limit: int) -> List[Dict]:
+        """Получает порцию необработанных сообщений топика после ключа (created_at, id)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # Keyset-пагинация: курсор не держим открытым между порциями,
+                # чтобы не блокировать запись результатов классификации
+                if after is None:
+                    cursor.execute('''
+                        SELECT * FROM chat_messages
+                        WHERE topic_id IS ? AND processed = FALSE
+                        ORDER BY created_at ASC, id ASC
+                        LIMIT ?
+                    ''', (topic_id, limit))
+                else:
+                    cursor.execute('''
+                        SELECT * FROM chat_messages
+                        WHERE topic_id IS ? AND processed = FALSE
+                          AND (created_at > ? OR (created_at = ? AND id > ?))
+                        ORDER BY created_at ASC, id ASC
+                        LIMIT ?
+                    ''', (topic_id, after[0], after[0], after[1], limit))
+                rows = cursor.fetchall()
+                columns = [description[0] for description in cursor.description]
+                return [dict(zip(columns, row)) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения порции необработанных сообщений: {e}")
+            return []
+
+    def get_active_threads_with_messages(self, days: int = 7,
+                                         classifications: Optional[Tuple[str, ...]] = None) -> List[Dict]:
+        """Получает активные треды с сообщениями за период
+
+        classifications - если задано, только треды с этими классификациями (фильтр выполняется в SQL)
+        """
+        try:
+            params: list = [f'-{days} days']
+            classification_filter = ''
+            if classifications:
+                classification_filter = f"AND mt.classification_id IN ({','.join('?' * len(classifications))})"
+                params.extend(classifications)
+
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT
+                        t.thread_id,
+                        t.title,
+                        t.classification_id,
+                        t.created_at,
+                        t.message_count,
+                        t.messages,
+                        t.topic_id,
+                        st.topic_name
+                    FROM (
+                        SELECT 
+                            mt.thread_id,
+                            mt.title,
+                            mt.classification_id,
+                            mt.created_at,
+                            COUNT(cm.id) as message_count,
+                            GROUP_CONCAT(cm.message_text, ' ||| ') as messages,
+                            MAX(cm.topic_id) as topic_id
+                        FROM message_threads mt
+                        LEFT JOIN chat_messages cm ON mt.thread_id = cm.thread_id 
+                            AND cm.created_at >= datetime('now', ?)
+                        WHERE mt.is_active = TRUE
+                          {classification_filter}
+                        GROUP BY mt.thread_id
+                    ) t
+                    LEFT JOIN source_topics st ON st.topic_id = t.topic_id
+                    ORDER BY t.created_at DESC
+                ''', params)
 
                 rows = cursor.fetchall()
                 result = []
@@ -447,7 +690,9 @@ class Database:
                         'classification_id': row[2],
                         'created_at': row[3],
                         'message_count': row[4],
-                        'messages': row[5].split(' ||| ') if row[5] else []
+                        'messages': row[5].split(' ||| ') if row[5] else [],
+                        'topic_id': row[6],  # Топик сообщений треда (у самих тредов топика нет)
+                        'topic_name': row[7]  # Название топика-источника; None, если топик не источник
                     }
                     result.append(thread_data)
                 return result
@@ -458,7 +703,7 @@ class Database:
     def get_message_thread_by_parent(self, parent_message_id: int) -> Optional[Dict]:
         """Получает тред по parent_message_id"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT thread_id, classification_id 
@@ -473,10 +718,56 @@ class Database:
             logger.error(f"Ошибка получения треда по родителю: {e}")
             return None
 
+    def get_message_threads_by_parents(self, parent_message_ids: List[int]) -> Dict[int, Dict]:
+        """Получает треды сразу для нескольких родительских сообщений: {parent_message_id: тред}"""
+        if not parent_message_ids:
+            return {}
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(parent_message_ids))
+                cursor.execute(f'''
+                    SELECT message_id, thread_id, classification_id 
+                    FROM chat_messages 
+                    WHERE message_id IN ({placeholders}) AND thread_id IS NOT NULL
+                ''', list(parent_message_ids))
+                return {row[0]: {'thread_id': row[1], 'classification_id': row[2]} for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка получения тредов по родителям: {e}")
+            return {}
+
+    def get_threads_version_for_topic(self, topic_id: int, days: int = 7) -> Optional[tuple]:
+        """Дешевая версия активных тредов топика: меняется при привязке сообщений к тредам топика,
+        создании и закрытии его тредов и выходе сообщений за период.
+
+        Учитываются все сообщения тредов топика за период, в том числе из других топиков:
+        они попадают в контекст треда в промпте. Треды других топиков версию не меняют
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT COUNT(*), MAX(cm.id), SUM(cm.thread_id), SUM(mt.is_active)
+                    FROM chat_messages cm
+                    JOIN message_threads mt ON mt.thread_id = cm.thread_id
+                    WHERE cm.created_at >= datetime('now', ?)
+                      AND cm.thread_id IN (
+                          SELECT thread_id
+                          FROM chat_messages
+                          WHERE topic_id = ?
+                            AND thread_id IS NOT NULL
+                            AND created_at >= datetime('now', ?)
+                      )
+                ''', (f'-{days} days', topic_id, f'-{days} days'))
+                return tuple(cursor.fetchone())
+        except Exception as e:
+            logger.error(f"Ошибка получения версии тредов топика {topic_id}: {e}")
+            return None
+
     def get_active_threads_with_messages_for_topic(self, topic_id: int, days: int = 7) -> List[Dict]:
         """Получает активные треды с сообщениями за период для конкретного топика"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 # Сначала находим все thread_id, связанные с сообщениями в заданном топике за период
                 cursor.execute('''
@@ -528,37 +819,63 @@ class Database:
 
     def get_threads_by_classification(self, classification_id: str, days: int = 7) -> List[Dict]:
         """Получает треды с указанной классификацией за период"""
+        return self.get_threads_by_classifications([classification_id], days=days)
+
+    def get_threads_by_classifications(self, classification_ids: List[str], days: int = 7) -> List[Dict]:
+        """Получает треды с любой из указанных классификаций за период одним запросом"""
+        if not classification_ids:
+            return []
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
+                placeholders = ','.join('?' * len(classification_ids))
+                cursor.execute(f'''
                     SELECT * FROM message_threads
-                    WHERE classification_id = ?
+                    WHERE classification_id IN ({placeholders})
                       AND created_at >= datetime('now', ?)
                       AND is_active = TRUE
                     ORDER BY created_at DESC
-                ''', (classification_id, f'-{days} days'))
+                ''', list(classification_ids) + [f'-{days} days'])
                 rows = cursor.fetchall()
-                result = []
-                for row in rows:
-                    thread_data = {
+                if not rows:
+                    return []
+
+                # Сообщения для контекста (по 5 последних на тред) - одним запросом на все треды, а не по запросу на тред
+                thread_ids = [row[0] for row in rows]
+                placeholders = ','.join('?' * len(thread_ids))
+                cursor.execute(f'''
+                    SELECT thread_id, message_text FROM (
+                        SELECT thread_id, message_text,
+                               ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY created_at DESC) AS rn
+                        FROM chat_messages
+                        WHERE thread_id IN ({placeholders})
+                    )
+                    WHERE rn <= 5
+                    ORDER BY thread_id, rn
+                ''', thread_ids)
+                messages_by_thread: Dict[int, List[str]] = {}
+                for thread_id, message_text in cursor.fetchall():
+                    messages_by_thread.setdefault(thread_id, []).append(message_text)
+
+                return [
+                    {
                         'thread_id': row[0],
                         'title': row[1],
                         'classification_id': row[2],
                         'created_at': row[3],
                         'is_active': row[4],
-                        'messages': self.get_messages_for_thread(row[0], limit=5) # Получаем сообщения для контекста
+                        'messages': messages_by_thread.get(row[0], [])
                     }
-                    result.append(thread_data)
-                return result
+                    for row in rows
+                ]
         except Exception as e:
-            logger.error(f"Ошибка получения тредов классификации {classification_id}: {e}")
+            logger.error(f"Ошибка получения тредов классификаций {classification_ids}: {e}")
             return []
 
     def get_messages_for_thread(self, thread_id: int, limit: int = 10) -> List[str]:
         """Получает текст сообщений для указанного треда (для контекста)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT message_text FROM chat_messages
@@ -575,7 +892,7 @@ class Database:
     def get_last_announcement(self) -> Optional[str]:
         """Получает текст последнего анонса целей (classification_id = 'announce')"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 # Предполагаем, что announce - это сообщение в chat_messages с classification_id = 'announce'
                 cursor.execute('''
@@ -590,12 +907,119 @@ class Database:
             logger.error(f"Ошибка получения последнего анонса: {e}")
             return None
 
+    # === Методы для кэша классификации ===
+
+    def get_cached_classifications(self, cache_keys: List[str], ttl_days: int = 30) -> Dict[str, Dict]:
+        """Получает закэшированные результаты классификации по ключам (не старше ttl_days)"""
+        if not cache_keys:
+            return {}
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(cache_keys))
+                cursor.execute(f'''
+                    SELECT cache_key, classification, title, confidence
+                    FROM classification_cache
+                    WHERE cache_key IN ({placeholders})
+                      AND created_at >= datetime('now', ?)
+                ''', list(cache_keys) + [f'-{ttl_days} days'])
+                return {
+                    row[0]: {'classification': row[1], 'title': row[2], 'confidence': row[3]}
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша классификации: {e}")
+            return {}
+
+    def save_cached_classifications(self, entries: List[Dict]) -> bool:
+        """Сохраняет результаты классификации в кэш"""
+        if not entries:
+            return True
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO classification_cache
+                    (cache_key, classification, title, confidence, model_version, created_at)
+                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', [
+                    (e['cache_key'], e['classification'], e.get('title'), e.get('confidence'), e.get('model_version'))
+                    for e in entries
+                ])
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша классификации: {e}")
+            return False
+
+    def cleanup_classification_cache(self, days: int = 30) -> int:
+        """Удаляет записи кэша классификации старше указанного количества дней"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "DELETE FROM classification_cache WHERE created_at < datetime('now', ?)",
+                    (f'-{days} days',)
+                )
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки кэша классификации: {e}")
+            return 0
+
+    # === Методы для кэша ответов LLM ===
+
+    def get_cached_llm_response(self, cache_key: str, ttl_days: int = 7) -> Optional[str]:
+        """Получает закэшированный ответ LLM по ключу (не старше ttl_days)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT response FROM llm_response_cache
+                    WHERE cache_key = ? AND created_at >= datetime('now', ?)
+                ''', (cache_key, f'-{ttl_days} days'))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша ответов LLM: {e}")
+            return None
+
+    def save_cached_llm_response(self, cache_key: str, response: str) -> bool:
+        """Сохраняет ответ LLM в кэш"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO llm_response_cache (cache_key, response, created_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (cache_key, response))
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша ответов LLM: {e}")
+            return False
+
+    def cleanup_llm_response_cache(self, days: int = 7) -> int:
+        """Удаляет ответы LLM из кэша старше указанного количества дней"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "DELETE FROM llm_response_cache WHERE created_at < datetime('now', ?)",
+                    (f'-{days} days',)
+                )
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки кэша ответов LLM: {e}")
+            return 0
+
     # === Методы для работы с AI моделями ===
 
     def get_all_models(self) -> Dict[str, str]:
         """Получает все AI модели из базы данных"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT name, model_path FROM ai_models")
                 rows = cursor.fetchall()
@@ -607,7 +1031,7 @@ class Database:
     def add_model(self, name: str, model_path: str) -> bool:
         """Добавляет новую AI модель в базу данных"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO ai_models (name, model_path) VALUES (?, ?)",
@@ -624,7 +1048,7 @@ class Database:
     def remove_model(self, name: str) -> bool:
         """Удаляет AI модель из базы данных"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM ai_models WHERE name = ?", (name,))
                 conn.commit()
@@ -641,7 +1065,7 @@ class Database:
     def get_prompt(self, prompt_type: str) -> Optional[str]:
         """Получает промпт по типу (возвращает один промпт)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "SELECT text FROM prompts WHERE type = ? ORDER BY rowid LIMIT 1",
@@ -658,7 +1082,7 @@ class Database:
     def update_prompt(self, prompt_type: str, prompt_text: str) -> bool:
         """Обновляет или создает промпт по типу"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
 
                 # Сначала проверяем, существует ли уже промпт такого типа
@@ -1,4 +1,3 @@
-import os
 import logging
 from aiogram import Dispatcher, F
 from aiogram.filters import Command, StateFilter
@@ -364,11 +363,12 @@ async def cmd_post(message: Message, bot, posting_service):
     try:
         args = message.text.split()[1:]
 
-        if not args or args[0] not in ["announce", "digest"]:
+        if not args or args[0] not in ["announce", "digest", "all"]:
             await message.answer(
                 "Использование:\n"
                 "• <code>/post announce</code> - понедельничный пост\n"
-                "• <code>/post digest</code> - пятничный дайджест",
+                "• <code>/post digest</code> - пятничный дайджест\n"
+                "• <code>/post all</code> - оба поста параллельно",
                 parse_mode="HTML"
             )
             return
@@ -537,22 +537,14 @@ async def handle_html_file(message: Message, state: FSMContext, html_parser, bot
             await message.answer("❌ Файл должен быть в формате HTML")
             return
 
-        # Скачиваем файл
+        # Скачиваем файл в память: парсер читает его потоково, временный файл на диске не нужен
         file_info = await bot.get_file(message.document.file_id)
         downloaded_file = await bot.download_file(file_info.file_path)
 
-        # Сохраняем временный файл
-        temp_file_path = f"temp_messages_{message.from_user.id}.html"
-        with open(temp_file_path, 'wb') as f:
-            f.write(downloaded_file.read())
-
         await message.answer("⏳ <b>Начинаю парсинг файла...</b>", parse_mode="HTML")
 
         # Парсим HTML файл
-        result = await html_parser.parse_html_file(temp_file_path)
-
-        # Удаляем временный файл
-        os.remove(temp_file_path)
+        result = await html_parser.parse_html_file(downloaded_file)
 
         if result['success']:
             await message.answer(
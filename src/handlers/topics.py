@@ -6,7 +6,7 @@ from aiogram.types import Message
 logger = logging.getLogger(__name__)
 
 
-async def cmd_add_topic(message: Message, db):
+async def cmd_add_topic(message: Message, db, source_topics_filter=None):
     """Добавляет текущий топик для парсинга"""
     try:
         # Проверяем, что команда выполнена в топике форума
@@ -31,6 +31,8 @@ async def cmd_add_topic(message: Message, db):
                 topic_name = message.reply_to_message.forum_topic_created.name or "Без названия"
 
         if db.add_source_topic(topic_id, topic_name):
+            if source_topics_filter:
+                source_topics_filter.invalidate()
             response = f"✅ Топик добавлен в источники:\nID: <code>{topic_id}</code>\nНазвание: {topic_name}"
             await message.answer(response, parse_mode="HTML")
         else:
@@ -41,7 +43,7 @@ async def cmd_add_topic(message: Message, db):
         await message.answer("❌ Ошибка при добавлении топика")
 
 
-async def cmd_delete_topic(message: Message, db):
+async def cmd_delete_topic(message: Message, db, source_topics_filter=None):
     """Удаляет текущий топик из источников"""
     try:
         # Проверяем, что команда выполнена в топике форума
@@ -55,6 +57,8 @@ async def cmd_delete_topic(message: Message, db):
         topic_id = message.message_thread_id
 
         if db.remove_source_topic(topic_id):
+            if source_topics_filter:
+                source_topics_filter.invalidate()
             await message.answer(f"✅ Топик удален из источников\nID: <code>{topic_id}</code>", parse_mode="HTML")
         else:
             await message.answer(f"❌ Топик не найден в источниках\nID: <code>{topic_id}</code>", parse_mode="HTML")
@@ -191,18 +195,22 @@ async def cmd_show_config(message: Message, db, main_chat_id):
         await message.answer("❌ Ошибка при получении конфигурации")
 
 
-def register_topic_handlers(dp: Dispatcher, db, main_chat_id):
-    """Регистрирует обработчики управления топиками"""
+def register_topic_handlers(dp: Dispatcher, db, main_chat_id, source_topics_filter=None):
+    """
+    Регистрирует обработчики управления топиками
+
+    source_topics_filter - фильтр топиков-источников, кэш которого сбрасывается при их изменении
+    """
 
     # Создаем замыкания для обработчиков, которым нужны дополнительные параметры
     async def wrapped_show_config(message: Message):
         await cmd_show_config(message, db, main_chat_id)
 
     async def wrapped_add_topic(message: Message):
-        await cmd_add_topic(message, db)
+        await cmd_add_topic(message, db, source_topics_filter)
 
     async def wrapped_delete_topic(message: Message):
-        await cmd_delete_topic(message, db)
+        await cmd_delete_topic(message, db, source_topics_filter)
 
     async def wrapped_select_announce_topic(message: Message):
         await cmd_select_announce_topic(message, db)
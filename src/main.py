@@ -14,6 +14,8 @@ from src.utils.filters import SourceTopicsFilter
 from src.services.posting_service import PostingService
 from src.services.html_parser import HTMLParserService
 from src.services.classification_service import ClassificationService
+from src.services.message_buffer import MessageWriteBuffer
+from src.utils.send_queue import SendQueue
 
 
 # === КОНФИГУРАЦИЯ ===
@@ -47,18 +49,22 @@ bot = Bot(token=BOT_TOKEN, timeout=60)
 dp = Dispatcher()
 db = Database()
 ai_client = AIClient(db)
-classification_service = ClassificationService(db, ai_client, batch_size=5)  # Количество сообщений разом посылаемых ИИ
-posting_service = PostingService(db, ai_client, MAIN_CHAT_ID, ADMIN_CHAT_ID)
+classification_service = ClassificationService(db, ai_client, batch_size=5)  # Начальное количество сообщений разом посылаемых ИИ (дальше подстраивается)
+send_queue = SendQueue(bot)  # Исходящие посты отправляются с учетом лимитов Telegram
+posting_service = PostingService(db, ai_client, MAIN_CHAT_ID, ADMIN_CHAT_ID, send_queue=send_queue)
 html_parser = HTMLParserService(db)
+message_buffer = MessageWriteBuffer(db)  # Входящие сообщения пишутся в БД пачками
 
 
 # Глобальные флаги состояния
 class BotState:
     def __init__(self):
-        self.processing_in_progress = False
+        self.processing_lock = asyncio.Lock()  # Не дает запустить обработку сообщений параллельно
         self.startup_processed = False
         self.last_message_processing_date = None
         self.last_cleanup_date = None
+        self.last_monday_post_date = None
+        self.last_friday_digest_date = None
 
 
 bot_state = BotState()
@@ -67,27 +73,25 @@ bot_state = BotState()
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 async def safe_process_unprocessed_messages():
     """Безопасная обработка сообщений в отдельной задаче"""
-    try:
-        logger.info("🔄 Начало безопасной обработки сообщений...")
-        processed_count = await classification_service.process_unprocessed_messages()
-        logger.info(f"✅ Обработка сообщений завершена. Обработано: {processed_count}")
-        return processed_count
-    except Exception as e:
-        logger.error(f"❌ Ошибка при обработке сообщений: {e}")
-        return 0
-    finally:
-        bot_state.processing_in_progress = False
-        logger.info("🔓 Снят флаг processing_in_progress")
+    async with bot_state.processing_lock:
+        try:
+            # Дописываем в БД сообщения, еще ожидающие в буфере
+            await message_buffer.flush()
+            logger.info("🔄 Начало безопасной обработки сообщений...")
+            processed_count = await classification_service.process_unprocessed_messages()
+            logger.info(f"✅ Обработка сообщений завершена. Обработано: {processed_count}")
+            return processed_count
+        except Exception as e:
+            logger.error(f"❌ Ошибка при обработке сообщений: {e}")
+            return 0
 
 
 async def safe_create_monday_post():
     """Безопасное создание понедельничного поста"""
     try:
-        # Сначала обрабатываем необработанные сообщения
-        if not bot_state.processing_in_progress:
-            logger.info("🔄 Перед созданием поста обрабатываем необработанные сообщения...")
-            bot_state.processing_in_progress = True
-            await safe_process_unprocessed_messages()
+        # Сначала обрабатываем необработанные сообщения (если обработка уже идет - дожидаемся её)
+        logger.info("🔄 Перед созданием поста обрабатываем необработанные сообщения...")
+        await safe_process_unprocessed_messages()
 
         # Затем создаем пост
         success = await posting_service.create_monday_post(bot)
@@ -104,11 +108,9 @@ async def safe_create_monday_post():
 async def safe_create_friday_digest():
     """Безопасное создание пятничного дайджеста"""
     try:
-        # Сначала обрабатываем необработанные сообщения
-        if not bot_state.processing_in_progress:
-            logger.info("🔄 Перед созданием дайджеста обрабатываем необработанные сообщения...")
-            bot_state.processing_in_progress = True
-            await safe_process_unprocessed_messages()
+        # Сначала обрабатываем необработанные сообщения (если обработка уже идет - дожидаемся её)
+        logger.info("🔄 Перед созданием дайджеста обрабатываем необработанные сообщения...")
+        await safe_process_unprocessed_messages()
 
         # Затем создаем дайджест
         success = await posting_service.create_friday_digest(bot)
@@ -126,6 +128,8 @@ async def safe_cleanup_messages():
     """Безопасная очистка сообщений"""
     try:
         deleted_count = db.cleanup_old_messages(days=MESSAGE_RETENTION_DAYS)
+        db.cleanup_classification_cache(days=classification_service.cache_ttl_days)
+        db.cleanup_llm_response_cache(days=ai_client.RESPONSE_CACHE_TTL_DAYS)
         if deleted_count > 0:
             logger.info(f"✅ Автоочистка БД: удалено {deleted_count} старых сообщений")
         else:
@@ -139,13 +143,16 @@ async def safe_cleanup_messages():
 # === РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ ===
 def register_all_handlers():
     """Регистрирует все обработчики бота"""
+    # Фильтр топиков-источников кэширует их список; команды управления топиками сбрасывают этот кэш
+    source_topics_filter = SourceTopicsFilter(db, MAIN_CHAT_ID)
+
     register_command_handlers(dp, db, bot, ai_client, posting_service, html_parser, classification_service)
-    register_topic_handlers(dp, db, MAIN_CHAT_ID)
+    register_topic_handlers(dp, db, MAIN_CHAT_ID, source_topics_filter)
 
     # Регистрация кастомного фильтра для топиков-источников
     dp.message.register(
         handle_source_topic_messages,
-        SourceTopicsFilter(db, MAIN_CHAT_ID)
+        source_topics_filter
     )
 
 
@@ -171,10 +178,8 @@ async def process_topic_message(message):
                 'classification_id': None
             }
 
-            if db.save_message(message_data):
-                logger.debug(f"Сообщение сохранено в БД для топика {topic_id}: {message.text[:50]}...")
-            else:
-                logger.error(f"Ошибка сохранения сообщения в БД для топика {topic_id}")
+            message_buffer.add(message_data)
+            logger.debug(f"Сообщение поставлено в очередь на запись для топика {topic_id}: {message.text[:50]}...")
 
     except Exception as e:
         logger.error(f"Error processing topic message: {e}")
@@ -191,47 +196,42 @@ async def scheduled_posting():
             weekday = now.strftime("%A")
 
             # Обработка при первом запуске бота
-            if not bot_state.startup_processed and not bot_state.processing_in_progress:
+            if not bot_state.startup_processed:
                 logger.info("🚀 Запуск первоначальной обработки накопленных сообщений...")
-                bot_state.processing_in_progress = True
                 asyncio.create_task(safe_process_unprocessed_messages())
                 bot_state.startup_processed = True
-                await asyncio.sleep(5)
 
             # Обработка необработанных сообщений - раз в сутки в 02:00
-            elif current_time == "02:00" and not bot_state.processing_in_progress:
-                if bot_state.last_message_processing_date != current_date:
-                    logger.info("🔄 Запуск ежедневной обработки сообщений...")
-                    bot_state.processing_in_progress = True
-                    asyncio.create_task(safe_process_unprocessed_messages())
-                    bot_state.last_message_processing_date = current_date
-                    await asyncio.sleep(60)
+            elif (current_time == "02:00" and bot_state.last_message_processing_date != current_date
+                  and not bot_state.processing_lock.locked()):
+                logger.info("🔄 Запуск ежедневной обработки сообщений...")
+                asyncio.create_task(safe_process_unprocessed_messages())
+                bot_state.last_message_processing_date = current_date
 
             # Понедельник 10:00 - цели/блокеры
-            elif weekday == "Monday" and current_time == "10:00":
+            elif (weekday == "Monday" and current_time == "10:00"
+                  and bot_state.last_monday_post_date != current_date):
                 logger.info("📅 Запуск создания понедельничного поста...")
                 asyncio.create_task(safe_create_monday_post())
-                await asyncio.sleep(60)
+                bot_state.last_monday_post_date = current_date
 
             # Пятница 19:00 - Weekly Digest
-            elif weekday == "Friday" and current_time == "19:00":
+            elif (weekday == "Friday" and current_time == "19:00"
+                  and bot_state.last_friday_digest_date != current_date):
                 logger.info("📊 Запуск создания пятничного дайджеста...")
                 asyncio.create_task(safe_create_friday_digest())
-                await asyncio.sleep(60)
+                bot_state.last_friday_digest_date = current_date
 
             # Ежедневная очистка в 03:00
-            elif current_time == "03:00":
-                if bot_state.last_cleanup_date != current_date:
-                    logger.info("🧹 Запуск ежедневной очистки БД...")
-                    asyncio.create_task(safe_cleanup_messages())
-                    bot_state.last_cleanup_date = current_date
-                    await asyncio.sleep(60)
+            elif current_time == "03:00" and bot_state.last_cleanup_date != current_date:
+                logger.info("🧹 Запуск ежедневной очистки БД...")
+                asyncio.create_task(safe_cleanup_messages())
+                bot_state.last_cleanup_date = current_date
 
             await asyncio.sleep(30)
 
         except Exception as e:
             logger.error(f"❌ Error in scheduled posting: {e}")
-            bot_state.processing_in_progress = False
             await asyncio.sleep(60)
 
 
@@ -264,14 +264,23 @@ async def main():
         # Регистрируем все обработчики
         register_all_handlers()
 
-        # Запускаем фоновую задачу постинга
+        # Запускаем фоновую запись входящих сообщений, очередь отправки и задачу постинга
+        buffer_task = asyncio.create_task(message_buffer.run())
+        send_task = asyncio.create_task(send_queue.run())
         asyncio.create_task(scheduled_posting())
 
         # Запускаем бота
         logger.info("🤖 Бот начинает polling...")
-        await dp.start_polling(bot, skip_updates=True)  # skip_updates чтобы избежать обработки старых сообщений
+        try:
+            await dp.start_polling(bot, skip_updates=True)  # skip_updates чтобы избежать обработки старых сообщений
+        finally:
+            # Останавливаем буфер: при отмене он дописывает накопленные сообщения
+            buffer_task.cancel()
+            send_task.cancel()
+            await asyncio.gather(buffer_task, send_task, return_exceptions=True)
     finally:
         await ai_client.close()
+        db.close()
 
 
 if __name__ == "__main__":
@@ -1,223 +1,112 @@
 import logging
 import asyncio
+import hashlib
 import json
 import re
-from typing import List, Dict
+import time
+from collections import defaultdict, deque
+from contextlib import AsyncExitStack
+from functools import lru_cache
+from typing import List, Dict, NotRequired, Optional, Tuple, TypedDict
+
+from src.services.similarity_cache import LexicalSimilarityCache
+from src.utils.bm25 import BM25Index
+from src.utils.json_stream import JsonArrayStreamParser
+from src.utils.rate_limiter import TokenBucket
+from src.utils.text import strip_filler, truncate_tokens
 
 logger = logging.getLogger(__name__)
 
+class ChatMessage(TypedDict):
+    """Строка chat_messages, как ее отдает Database"""
+    id: int
+    message_id: int
+    topic_id: Optional[int]
+    thread_id: Optional[int]
+    parent_message_id: Optional[int]
+    classification_id: Optional[str]
+    message_text: str
+    created_at: str
+    processed: bool
 
-class ClassificationService:
-    def __init__(self, db, ai_client, batch_size: int = 5):
-        self.db = db
-        self.ai_client = ai_client
-        self.batch_size = batch_size
 
-    async def process_unprocessed_messages(self):
-        """Обрабатывает необработанные сообщения с пакетной классификацией, сгруппированной по топикам"""
-        try:
-            unprocessed_messages = self.db.get_unprocessed_messages()
-            if not unprocessed_messages:
-                logger.info("Нет необработанных сообщений")
-                return 0
+class ActiveThread(TypedDict):
+    """Активный тред с сообщениями за период, как его отдает Database"""
+    thread_id: int
+    title: Optional[str]
+    classification_id: str
+    created_at: str
+    message_count: int
+    messages: List[str]
+    topic_id: NotRequired[int]  # Только в общем пакете нескольких топиков
 
-            # Группируем необработанные сообщения по топику
-            messages_by_topic = {}
-            for msg in unprocessed_messages:
-                topic_id = msg['topic_id']
-                if topic_id not in messages_by_topic:
-                    messages_by_topic[topic_id] = []
-                messages_by_topic[topic_id].append(msg)
-
-            total_processed = 0
-            logger.info(f"Найдено {len(unprocessed_messages)} необработанных сообщений в {len(messages_by_topic)} топиках")
-
-            for topic_id, topic_messages in messages_by_topic.items():
-                logger.info(f"Обработка топика {topic_id}: {len(topic_messages)} сообщений")
-                # Получаем активные треды ТОЛЬКО для этого топика
-                active_threads = self.db.get_active_threads_with_messages_for_topic(topic_id, days=7)
-                logger.info(f"Найдено {len(active_threads)} активных тредов в топике {topic_id}")
-
-                # Разбиваем сообщения топика на пакеты
-                batches = [topic_messages[i:i + self.batch_size]
-                           for i in range(0, len(topic_messages), self.batch_size)]
-
-                topic_processed = 0
-                for batch_num, batch in enumerate(batches, 1):
-                    logger.info(f"Топик {topic_id}: Обработка пакета {batch_num}/{len(batches)} ({len(batch)} сообщений)")
-                    processed_in_batch = await self.process_batch(batch, active_threads)
-                    topic_processed += processed_in_batch
 
-                    # Добавляем паузу между пакетами
-                    if batch_num < len(batches):
-                        await asyncio.sleep(0.1)  # 100ms пауза
+class SlingResult(TypedDict):
+    """Результат семантического слинга одного сообщения"""
+    message_id: int
+    related: bool
+    thread_id: Optional[int]
+    confidence: float
 
-                total_processed += topic_processed
-                logger.info(f"Обработка топика {topic_id} завершена. Обработано: {topic_processed}")
 
-            logger.info(f"Обработка ВСЕХ топиков завершена. Всего обработано: {total_processed}")
-            return total_processed
+class ClassificationResult(TypedDict):
+    """Результат классификации одного сообщения"""
+    classification: str  # 'goal', 'blocker' или 'other'
+    confidence: float
+    title: Optional[str]
 
-        except Exception as e:
-            logger.error(f"Ошибка обработки необработанных сообщений: {e}")
-            return 0
 
-    # Остальные методы остаются без изменений, так как они уже принимают batch и active_threads
-    # и работают с ними в контексте текущего топика (через batch и active_threads, полученные выше).
-    # ... (остальные методы как в предыдущем обновленном коде, без изменений) ...
-    async def process_batch(self, messages_batch: List[Dict], active_threads: List[Dict]) -> int:
-        """Обрабатывает пакет сообщений"""
-        try:
-            processed_count = 0
+class CombinedResult(ClassificationResult):
+    """Результат совмещенного запроса: привязка к треду ('sling') или классификация ('new'/'other')"""
+    action: str
+    thread_id: Optional[int]
 
-            # Шаг 1: Обработка реплаев (не требует AI)
-            remaining_messages = await self._batch_step1_replies(messages_batch)
-            processed_count += (len(messages_batch) - len(remaining_messages))
 
-            if not remaining_messages:
-                return processed_count
-
-            # Шаг 2: Пакетный семантический слинг
-            sling_processed, remaining_after_sling = await self._batch_step2_semantic_sling(remaining_messages,
-                                                                                            active_threads)
-            processed_count += sling_processed
+# Версия схемы ответа классификации: при изменении промпта/формата старые записи кэша перестают совпадать
+CLASSIFICATION_CACHE_SCHEMA = "batch-classification-v1"
 
-            if not remaining_after_sling:
-                return processed_count
-
-            # Шаг 3: Пакетная классификация новых сущностей
-            classification_processed = await self._batch_step3_new_entities(remaining_after_sling)
-            processed_count += classification_processed
-
-            return processed_count
+# Markdown-обрамление ```json ... ```, которое модели иногда добавляют вокруг JSON
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
 
-        except Exception as e:
-            logger.error(f"Ошибка обработки пакета: {e}")
-            # Резервный вариант: индивидуальная обработка
-            return await self._fallback_individual_processing(messages_batch, active_threads)
+# Короткие ответы-реакции, которые всегда классифицируются как 'other' без обращения к AI
+_TRIVIAL_REPLIES = frozenset({
+    "+", "++", "ok", "ок", "окей", "да", "нет", "ага", "угу", "понял", "поняла", "хорошо", "ясно",
+    "спасибо", "спс", "благодарю", "спасибо большое", "👍", "🔥", "👌", "🙏", "❤️",
+})
+_NON_WORD_RE = re.compile(r'[\s\W]+')
 
-    async def _batch_step1_replies(self, messages_batch: List[Dict]) -> List[Dict]:
-        """Пакетная обработка реплаев"""
-        remaining_messages = []
+# Пробельные символы при нормализации текста для ключа кэша
+_WS_RE = re.compile(r'\s+')
 
-        for message in messages_batch:
-            if await self._step1_check_reply(message):
-                continue  # Сообщение обработано
-            remaining_messages.append(message)
+# Поля результата классификации для резервного разбора невалидного JSON за один проход
+_RESULT_FIELD_RE = re.compile(r'"(classification|confidence|title)":\s*("[^"]*"|[0-9.]+|null)')
 
-        logger.debug(f"Шаг 1: обработано реплаев: {len(messages_batch) - len(remaining_messages)}")
-        return remaining_messages
 
-    async def _batch_step2_semantic_sling(self, messages_batch: List[Dict], active_threads: List[Dict]) -> tuple[
-        int, List[Dict]]:
-        """Пакетный семантический слинг"""
-        if not messages_batch or not active_threads:
-            logger.info("Пропуск слинга: нет сообщений или активных тредов.")
-            return 0, messages_batch
-
-        try:
-            # Создаем пакетный запрос для всех сообщений
-            batch_prompt = self._create_batch_sling_prompt(messages_batch, active_threads)
-            response = await self.ai_client.send_request_with_retry(batch_prompt)
-
-            # Парсим ответ и применяем результаты
-            sling_results = self._parse_batch_sling_response(response)
-
-            processed_count = 0
-            remaining_messages = []
-
-            for i, message in enumerate(messages_batch):
-                if i < len(sling_results) and sling_results[i]['related'] and sling_results[i]['thread_id']:
-                    # Получаем информацию о треде, к которому привязываем
-                    thread = self.db.get_thread_by_id(sling_results[i]['thread_id'])
-                    if thread:
-                        # Привязываем сообщение к найденному треду, используя его классификацию
-                        # Классификация сообщения в треде наследуется от треда
-                        self.db.update_message_thread(
-                            message['message_id'],
-                            sling_results[i]['thread_id'],
-                            thread['classification_id'] # <-- Классификация наследуется от треда
-                        )
-                        processed_count += 1
-                        logger.debug(
-                            f"Пакетный слинг: сообщение {message['message_id']} → тред {sling_results[i]['thread_id']} (классификация: {thread['classification_id']})")
-                    else:
-                        logger.warning(f"Тред {sling_results[i]['thread_id']} не найден в БД при слинге.")
-                        remaining_messages.append(message)
-                else:
-                    # Если AI не нашел связи, оставляем сообщение для дальнейшей классификации
-                    remaining_messages.append(message)
-
-            logger.debug(f"Шаг 2: пакетный слинг обработал: {processed_count}")
-            return processed_count, remaining_messages
-
-        except Exception as e:
-            logger.error(f"Ошибка пакетного слинга: {e}")
-            return 0, messages_batch
-
-    async def _batch_step3_new_entities(self, messages_batch: List[Dict]) -> int:
-        """Пакетная классификация новых сущностей"""
-        if not messages_batch:
-            return 0
-
-        try:
-            # Создаем пакетный запрос для классификации
-            batch_prompt = self._create_batch_classification_prompt(messages_batch)
-            response = await self.ai_client.send_request_with_retry(batch_prompt)
-
-            # Парсим результаты
-            classification_results = self._parse_batch_classification_response(response)
-            processed_count = 0
-
-            for i, message in enumerate(messages_batch):
-                if i < len(classification_results):
-                    result = classification_results[i]
-                    # Применяем результат классификации, который может создать новый тред
-                    if await self._apply_classification_result(message, result):
-                        processed_count += 1
-                else:
-                    # Если не хватило результатов, помечаем как 'other'
-                    self.db.update_message_thread(message['message_id'], None, 'other')
-                    processed_count += 1
-                    logger.warning(f"Нет результата классификации для сообщения {message['message_id']}, помечено как 'other'.")
-
-            logger.debug(f"Шаг 3: пакетная классификация обработала: {processed_count}")
-            return processed_count
+class ClassificationService:
+    # Бюджет (в приблизительных токенах) на текст одного сообщения в промптах
+    SLING_MESSAGE_TOKENS = 120
+    CLASSIFICATION_MESSAGE_TOKENS = 400
 
-        except Exception as e:
-            logger.error(f"Ошибка пакетной классификации: {e}")
-            # Резервный вариант: индивидуальная обработка
-            return await self._fallback_individual_classification(messages_batch)
+    # Сколько тредов попадает в промпт и сколько самых релевантных (BM25) берется на каждое сообщение
+    PROMPT_THREADS_LIMIT = 15
+    RELEVANT_THREADS_PER_MESSAGE = 5
 
-    def _create_batch_sling_prompt(self, messages_batch: List[Dict], active_threads: List[Dict]) -> str:
-        """Создает промпт для пакетного семантического слинга"""
-        # Форматируем треды для контекста, теперь включая *все* сообщения треда
-        threads_context = ""
-        for i, thread in enumerate(active_threads[:15]):  # Ограничиваем количество тредов для контекста
-            all_thread_messages = thread.get('messages', []) # Получаем все сообщения треда
-            # Формируем краткий превью темы и содержания
-            messages_preview = " ".join(all_thread_messages) if all_thread_messages else "Тред без сообщений."
-            # Ограничиваем длину превью, если оно слишком длинное
-            messages_preview = messages_preview[:300] + "..." if len(messages_preview) > 300 else messages_preview
-
-            threads_context += f"{i + 1}. Тред #{thread['thread_id']} (Классификация: {thread['classification_id']}):\n"
-            threads_context += f"   Заголовок: {thread['title']}\n"
-            threads_context += f"   Контекст (все сообщения): {messages_preview}\n\n"
+    # Неполные пакеты разных топиков объединяются в общий пакет: не больше стольких топиков,
+    # и от каждого в промпт попадает не больше стольких тредов
+    MIXED_BATCH_MAX_TOPICS = 5
+    MIXED_BATCH_THREADS_PER_TOPIC = 3
 
-        # Форматируем сообщения для классификации
-        messages_context = ""
-        for i, message in enumerate(messages_batch):
-            messages_context += f"{i + 1}. Сообщение ID {message['message_id']}:\n   \"{message['message_text'][:300]}\"\n\n"
+    _MIXED_TOPICS_NOTE = "\n\nСообщения из разных топиков: связывай сообщение только с тредом того же топика."
 
-        prompt = f"""
+    # Статические части промпта слинга: пример JSON задает только схему ответа и не зависит от пакета
+    _SLING_PROMPT_HEADER = """
 Ты - ассистент для семантического связывания сообщений в IT-сообществе.
 Твоя задача - определить, относится ли каждое из следующих сообщений по смыслу к одному из существующих тредов.
 
 СУЩЕСТВУЮЩИЕ ТРЕДЫ:
-{threads_context}
+"""
 
-СООБЩЕНИЯ ДЛЯ АНАЛИЗА:
-{messages_context}
+    _SLING_PROMPT_FOOTER = """
 
 ПРОЦЕСС АНАЛИЗА:
 1. Внимательно проанализируй КАЖДОЕ сообщение из 'СООБЩЕНИЯ ДЛЯ АНАЛИЗА'.
@@ -240,35 +129,62 @@ class ClassificationService:
 
 Верни ответ ТОЛЬКО в формате JSON без дополнительного текста:
 
-{{
+{
     "results": [
-        {{
-            "message_id": {messages_batch[0]['message_id']},
+        {
+            "message_id": 101,
             "related": true,
             "thread_id": 123,
             "confidence": 0.85
-        }},
-        {{
-            "message_id": {messages_batch[1]['message_id']}, 
+        },
+        {
+            "message_id": 102,
             "related": false,
             "thread_id": null,
             "confidence": 0.1
-        }}
+        }
     ]
-}}
+}
 
 Важно: верни результат для КАЖДОГО сообщения в том же порядке!
 """
-        return prompt
 
-    def _create_batch_classification_prompt(self, messages_batch: List[Dict]) -> str:
-        """Создает промпт для пакетной классификации"""
+    # Совмещенный промпт: слинг и классификация новых сущностей за один запрос
+    _COMBINED_PROMPT_HEADER = """
+Ты - ассистент для разбора сообщений IT-сообщества.
+Для каждого сообщения определи: относится ли оно по смыслу к одному из существующих тредов,
+а если нет - является ли оно новой целью, блокером или обычным сообщением.
+
+СУЩЕСТВУЮЩИЕ ТРЕДЫ:
+"""
 
-        messages_context = ""
-        for i, message in enumerate(messages_batch):
-            messages_context += f"{i + 1}. \"{message['message_text']}\"\n"
+    _COMBINED_PROMPT_FOOTER = """
+ПРОЦЕСС АНАЛИЗА:
+1. Сообщение СВЯЗАНО с тредом (action "sling"), если оно логически продолжает обсуждение в треде,
+   отвечает на вопросы треда или касается проекта, идеи или проблемы, описанной в треде.
+   Похожие слова в другом контексте - НЕ связь.
+2. Если сообщение не связано ни с одним тредом, классифицируй его:
+   - "goal" - новая идея, проект, исследование или задача для выполнения, которая может быть отслеживаемой.
+   - "blocker" - конкретная проблема или обстоятельство, которое мешает работе над текущими целями или проектами.
+   Для goal/blocker укажи action "new" и краткое информативное название (3-5 слов).
+   - Обычное сообщение, комментарий или факт - action "other".
+3. Оцени уверенность от 0 до 1.
+
+Верни ответ ТОЛЬКО в формате JSON без дополнительного текста:
+
+{
+    "results": [
+        {"message_index": 0, "action": "sling", "thread_id": 123, "classification": null, "title": null, "confidence": 0.85},
+        {"message_index": 1, "action": "new", "thread_id": null, "classification": "goal", "title": "Разработка нового модуля", "confidence": 0.8},
+        {"message_index": 2, "action": "other", "thread_id": null, "classification": "other", "title": null, "confidence": 0.9}
+    ]
+}
+
+Важно: верни результат для КАЖДОГО сообщения! Индексы должны начинаться с 0.
+"""
 
-        prompt = f"""
+    # Статические части промпта пакетной классификации
+    _CLASSIFICATION_PROMPT_HEADER = """
 Ты - классификатор сообщений для IT-сообщества. 
 Проанализируй сообщения и определи их типы.
 
@@ -278,7 +194,9 @@ class ClassificationService:
 - "other" - обычное сообщение, комментарий, факт, не требующее отдельного отслеживания как goal или blocker.
 
 СООБЩЕНИЯ ДЛЯ КЛАССИФИКАЦИИ:
-{messages_context}
+"""
+
+    _CLASSIFICATION_PROMPT_FOOTER = """
 
 ПРОЦЕСС КЛАССИФИКАЦИИ:
 1. Проанализируй КАЖДОЕ сообщение отдельно.
@@ -293,60 +211,800 @@ class ClassificationService:
 
 Верни ответ ТОЛЬКО в формате JSON без дополнительного текста:
 
-{{
+{
     "results": [
-        {{
+        {
             "message_index": 0,
             "classification": "goal",
             "confidence": 0.8,
             "title": "Разработка нового модуля"
-        }},
-        {{
+        },
+        {
             "message_index": 1, 
             "classification": "other",
             "confidence": 0.9,
             "title": null
-        }}
+        }
     ]
-}}
+}
 
 Важно: верни результат для КАЖДОГО сообщения в том же порядке! Индексы должны начинаться с 0.
 """
-        return prompt
 
-    def _parse_batch_sling_response(self, response: str) -> List[Dict]:
+    def __init__(self, db, ai_client, batch_size: int = 5, read_chunk_size: int = 500, cache_ttl_days: int = 30,
+                 similarity_threshold: float = 0.95, max_concurrency: int = 4, concurrent_batches: int = 3,
+                 min_batch_size: int = 1, max_batch_size: int = 32, latency_slo: float = 30.0,
+                 fused_prompt: bool = True, rate: float = 60, period: float = 60.0):
+        self.db = db
+        self.ai_client = ai_client
+        self.batch_size = batch_size  # Начальный размер пакета, дальше подстраивается по задержке AI
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.latency_slo = latency_slo  # Допустимый p95 времени обработки пакета (сек)
+        self._latency_per_message_ewma: Optional[float] = None
+        self._batch_latencies: deque = deque(maxlen=20)
+        self._threads_cache: Dict[tuple, tuple] = {}  # (topic_id, days) -> (версия тредов топика, треды)
+        self.fused_prompt = fused_prompt  # Слинг и классификация одним запросом к AI
+        self.read_chunk_size = read_chunk_size  # Сколько строк читаем из БД за один запрос
+        self.concurrent_batches = concurrent_batches  # Сколько пакетов одновременно находятся в обработке у AI
+        self.cache_ttl_days = cache_ttl_days  # Сколько дней живет закэшированный результат классификации
+        self.similarity_cache = LexicalSimilarityCache(threshold=similarity_threshold)  # Классификация почти совпадающих текстов
+        self.max_concurrency = max_concurrency  # Сколько индивидуальных запросов к AI выполняется одновременно
+        self._individual_semaphore = asyncio.Semaphore(max_concurrency)
+        self._rate_limiter = TokenBucket(rate, period)  # Лимит провайдера AI: не больше rate запросов за period секунд
+
+    async def process_unprocessed_messages(self):
+        """Обрабатывает необработанные сообщения с пакетной классификацией, сгруппированной по топикам.
+
+        Сообщения читаются из БД порциями (producer), готовые пакеты попадают
+        в ограниченную очередь, откуда их разбирают воркеры, обращающиеся к AI
+        """
+        try:
+            pending_by_topic: Dict[int, List[ChatMessage]] = {}
+            threads_by_topic: Dict[int, asyncio.Task] = {}
+            processed_by_topic: Dict[str, int] = {}  # Топик (или список топиков общего пакета) -> обработано
+            total_messages = 0
+
+            # Ограниченная очередь дает backpressure: чтение из БД ждет, пока воркеры не освободятся
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrent_batches * 2)
+
+            async def load_threads(topic_id: int) -> List[ActiveThread]:
+                threads = await self._get_active_threads_cached(topic_id, days=7)
+                logger.info(f"Найдено {len(threads)} активных тредов в топике {topic_id}")
+                return threads
+
+            async def produce():
+                nonlocal total_messages
+                # БД отдает сообщения по топикам (группировка в SQL); порции читаются в пуле потоков,
+                # чтобы не блокировать воркеров
+                chunks = self.db.iter_unprocessed_by_topic(chunk_size=self.read_chunk_size)
+                while item := await self.db.run(next, chunks, None):
+                    topic_id, chunk = item
+                    # Активные треды топика начинаем загружать, как только встретили топик (один раз за запуск),
+                    # параллельно с чтением сообщений и обработкой других топиков
+                    if topic_id not in threads_by_topic:
+                        threads_by_topic[topic_id] = asyncio.create_task(load_threads(topic_id))
+                    pending = pending_by_topic.setdefault(topic_id, [])
+                    for msg in chunk:
+                        total_messages += 1
+                        pending.append(msg)
+                        if len(pending) >= self.batch_size:
+                            await queue.put(((topic_id,), pending))
+                            pending = pending_by_topic[topic_id] = []
+
+                # Неполные пакеты разных топиков досылаем общими пакетами - меньше запросов к AI
+                for topic_ids, batch in self._group_partial_batches(pending_by_topic):
+                    await queue.put((topic_ids, batch))
+
+            # Пакеты одного топика обрабатываются по очереди: реплай в следующем пакете должен
+            # увидеть тред, который родитель получил в предыдущем. Параллельно идут только разные топики
+            topic_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+            async def worker():
+                while True:
+                    topic_ids, batch = await queue.get()
+                    try:
+                        # Блокировки берем в порядке очереди; общий пакет берет блокировки своих топиков
+                        # в одном и том же порядке, поэтому взаимоблокировок нет
+                        async with AsyncExitStack() as locks:
+                            for topic_id in sorted(topic_ids):
+                                await locks.enter_async_context(topic_locks[topic_id])
+                            await process(topic_ids, batch)
+                    finally:
+                        queue.task_done()
+
+            async def process(topic_ids: tuple, batch: List[ChatMessage]):
+                label = ", ".join(map(str, topic_ids))
+                try:
+                    if len(topic_ids) == 1:
+                        # Активные треды ТОЛЬКО для этого топика
+                        active_threads = await threads_by_topic[topic_ids[0]]
+                    else:
+                        active_threads = self._merge_topic_threads(
+                            {topic_id: await threads_by_topic[topic_id] for topic_id in topic_ids})
+
+                    logger.info(f"Топик {label}: Обработка пакета ({len(batch)} сообщений)")
+                    started = time.perf_counter()
+                    processed_in_batch = await self.process_batch(batch, active_threads)
+                    self._adapt_batch_size(time.perf_counter() - started, len(batch))
+                    processed_by_topic[label] = processed_by_topic.get(label, 0) + processed_in_batch
+                except Exception as e:
+                    logger.error(f"Ошибка обработки пакета топика {label}: {e}")
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrent_batches)]
+            try:
+                await produce()
+                await queue.join()
+            finally:
+                for task in workers:
+                    task.cancel()
+                for task in threads_by_topic.values():
+                    task.cancel()
+                await asyncio.gather(*workers, *threads_by_topic.values(), return_exceptions=True)
+
+            if not total_messages:
+                logger.info("Нет необработанных сообщений")
+                return 0
+
+            for label, topic_processed in processed_by_topic.items():
+                logger.info(f"Обработка топика {label} завершена. Обработано: {topic_processed}")
+
+            total_processed = sum(processed_by_topic.values())
+            logger.info(f"Обработка ВСЕХ топиков завершена ({total_messages} сообщений в {len(pending_by_topic)} топиках). "
+                        f"Всего обработано: {total_processed}")
+            return total_processed
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки необработанных сообщений: {e}")
+            return 0
+
+    def _group_partial_batches(self, pending_by_topic: Dict[int, List[ChatMessage]]
+                               ) -> List[Tuple[tuple, List[ChatMessage]]]:
+        """Объединяет неполные пакеты разных топиков в пакеты до batch_size сообщений: [(топики, сообщения)]"""
+        groups = []
+        topic_ids: List[int] = []
+        batch: List[ChatMessage] = []
+        for topic_id, pending in pending_by_topic.items():
+            if not pending:
+                continue
+            if batch and (len(batch) + len(pending) > self.batch_size or len(topic_ids) >= self.MIXED_BATCH_MAX_TOPICS):
+                groups.append((tuple(topic_ids), batch))
+                topic_ids, batch = [], []
+            topic_ids.append(topic_id)
+            batch.extend(pending)
+        if batch:
+            groups.append((tuple(topic_ids), batch))
+        return groups
+
+    def _merge_topic_threads(self, threads_by_topic: Dict[int, List[ActiveThread]]) -> List[ActiveThread]:
+        """Треды нескольких топиков для общего пакета; каждый тред помечен своим topic_id"""
+        return [{**thread, 'topic_id': topic_id}
+                for topic_id, threads in threads_by_topic.items()
+                for thread in threads[:self.MIXED_BATCH_THREADS_PER_TOPIC]]
+
+    @staticmethod
+    def _is_mixed_batch(messages_batch: List[ChatMessage]) -> bool:
+        """Пакет содержит сообщения нескольких топиков"""
+        return len({message.get('topic_id') for message in messages_batch}) > 1
+
+    @staticmethod
+    def _thread_allowed(thread: ActiveThread, message: ChatMessage, mixed: bool) -> bool:
+        """В общем пакете сообщение можно привязать только к треду его топика"""
+        return not mixed or thread.get('topic_id') == message.get('topic_id')
+
+    async def _get_active_threads_cached(self, topic_id: int, days: int = 7) -> List[ActiveThread]:
+        """Активные треды топика; повторно читаются из БД, только если изменилась их версия"""
+        key = (topic_id, days)
+        version = await self.db.run(self.db.get_threads_version_for_topic, topic_id, days)
+        cached = self._threads_cache.get(key)
+        if cached and version is not None and cached[0] == version:
+            return cached[1]
+
+        threads = await self.db.run(self.db.get_active_threads_with_messages_for_topic, topic_id, days)
+        self._threads_cache[key] = (version, threads)
+        return threads
+
+    def _invalidate_threads_cache(self, topic_ids):
+        """Сбрасывает кэш активных тредов для топиков, в которых появились новые треды"""
+        for key in [key for key in self._threads_cache if key[0] in topic_ids]:
+            del self._threads_cache[key]
+
+    def _adapt_batch_size(self, elapsed: float, batch_len: int):
+        """Подстраивает размер пакета: растет, пока падает задержка на сообщение, и уменьшается при превышении SLO"""
+        self._batch_latencies.append(elapsed)
+        previous_ewma = self._latency_per_message_ewma
+        latency_per_message = elapsed / batch_len
+        self._latency_per_message_ewma = (latency_per_message if previous_ewma is None
+                                          else 0.3 * latency_per_message + 0.7 * previous_ewma)
+
+        p95 = sorted(self._batch_latencies)[int(0.95 * (len(self._batch_latencies) - 1))]
+        current = self.batch_size
+        if p95 <= self.latency_slo and (previous_ewma is None or self._latency_per_message_ewma <= previous_ewma):
+            new_size = max(current + 1, round(current * 1.2))
+        else:
+            new_size = min(current - 1, round(current * 0.8))
+        self.batch_size = max(self.min_batch_size, min(self.max_batch_size, new_size))
+
+        if self.batch_size != current:
+            logger.debug(f"Размер пакета: {current} → {self.batch_size} "
+                         f"(p95 {p95:.1f} с, {self._latency_per_message_ewma:.2f} с/сообщение)")
+
+    async def process_batch(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> int:
+        """Обрабатывает пакет сообщений"""
+        try:
+            processed_count = 0
+
+            # Шаг 1: Обработка реплаев (не требует AI)
+            # Запросы к БД выполняются в пуле потоков, чтобы не блокировать event loop
+            remaining_messages = await self.db.run(self._batch_step1_replies, messages_batch)
+            processed_count += (len(messages_batch) - len(remaining_messages))
+
+            if not remaining_messages:
+                return processed_count
+
+            # Реакции и короткие ответы помечаем как 'other' без AI
+            trivial_processed, remaining_messages = await self._mark_trivial_other(remaining_messages)
+            processed_count += trivial_processed
+
+            if not remaining_messages:
+                return processed_count
+
+            # Без активных тредов слинг невозможен - сразу классифицируем новые сущности
+            if not active_threads:
+                return processed_count + await self._batch_step3_new_entities(remaining_messages)
+
+            # Шаги 2+3 одним запросом к AI; при неразборчивом ответе - по отдельности
+            if self.fused_prompt:
+                # Уже классифицированные тексты берем из кэша - в совмещенный запрос идут только промахи
+                resolved, remaining_messages = await self._lookup_cached(remaining_messages)
+                if resolved:
+                    processed_count += await self._apply_classification_results(resolved)
+                    logger.debug(f"Из кэша классифицировано до совмещенного запроса: {len(resolved)}")
+                if not remaining_messages:
+                    return processed_count
+
+                combined_processed = await self._batch_combined(remaining_messages, active_threads)
+                if combined_processed is not None:
+                    return processed_count + combined_processed
+
+            # Шаг 2: Пакетный семантический слинг
+            sling_updates, remaining_after_sling = await self._batch_step2_semantic_sling(remaining_messages,
+                                                                                          active_threads)
+
+            # Шаг 3: Пакетная классификация новых сущностей - запрос к AI уходит сразу,
+            # а результаты слинга тем временем записываются в БД
+            step3_task = (asyncio.create_task(self._batch_step3_new_entities(remaining_after_sling))
+                          if remaining_after_sling else None)
+            try:
+                processed_count += await self.db.run(self.db.update_message_threads_bulk, sling_updates)
+            finally:
+                if step3_task:
+                    processed_count += await step3_task
+
+            return processed_count
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки пакета: {e}")
+            # Резервный вариант: индивидуальная обработка
+            return await self._fallback_individual_processing(messages_batch, active_threads)
+
+    def _batch_step1_replies(self, messages_batch: List[ChatMessage]) -> List[ChatMessage]:
+        """Пакетная обработка реплаев: один запрос за тредами родителей и одно пакетное обновление"""
+        parent_ids = list({message['parent_message_id'] for message in messages_batch if message.get('parent_message_id')})
+        parent_threads = self.db.get_message_threads_by_parents(parent_ids)
+
+        remaining_messages = []
+        updates = []
+        for message in messages_batch:
+            parent_thread = parent_threads.get(message.get('parent_message_id'))
+            if not parent_thread:
+                remaining_messages.append(message)
+                continue
+
+            # Сообщение-реплай наследует тред и классификацию родителя
+            updates.append((message['message_id'], parent_thread['thread_id'], parent_thread['classification_id']))
+            # Реплай на это сообщение в том же пакете тоже должен найти тред
+            parent_threads[message['message_id']] = parent_thread
+            logger.info(
+                f"Сообщение {message['message_id']} привязано к треду {parent_thread['thread_id']} (наследование от родителя, классификация: {parent_thread['classification_id']})")
+
+        if updates and self.db.update_message_threads_bulk(updates) != len(updates):
+            logger.warning(f"Шаг 1: обновлены не все реплаи ({len(updates)} ожидалось)")
+
+        logger.debug(f"Шаг 1: обработано реплаев: {len(updates)}")
+        return remaining_messages
+
+    async def _mark_trivial_other(self, messages_batch: List[ChatMessage]) -> tuple:
+        """Помечает тривиальные сообщения как 'other' без AI: (сколько помечено, остальные сообщения)"""
+        trivial_ids = {message['message_id'] for message in messages_batch if self._is_trivial_other(message['message_text'])}
+        if not trivial_ids:
+            return 0, messages_batch
+
+        processed_count = await self.db.run(
+            self.db.update_message_threads_bulk, [(message_id, None, 'other') for message_id in trivial_ids])
+        logger.info(f"Без AI помечено как 'other' (тривиальные): {len(trivial_ids)}")
+        return processed_count, [message for message in messages_batch if message['message_id'] not in trivial_ids]
+
+    async def _batch_combined(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> Optional[int]:
+        """Слинг и классификация новых сущностей одним запросом к AI.
+
+        Ответ AI читается потоком: готовые результаты пишутся в БД, не дожидаясь конца генерации.
+        Возвращает количество обработанных сообщений или None, если ответ AI не удалось разобрать -
+        тогда пакет обрабатывается прежним двухшаговым путем
+        """
+        mixed = self._is_mixed_batch(messages_batch)
+        threads = {thread['thread_id']: thread for thread in active_threads}
+        handled = set()  # Индексы сообщений, по которым результат уже получен
+        leftovers = []  # Сообщения без пригодного результата - классифицируем отдельно
+        stats = {'sling': 0, 'classified': 0}
+
+        async def apply(results: Dict[int, CombinedResult]) -> int:
+            missing_ids = {r['thread_id'] for r in results.values()
+                           if r['action'] == 'sling' and r['thread_id'] not in threads}
+            if missing_ids:
+                threads.update((thread['thread_id'], thread)
+                               for thread in await self.db.run(self.db.get_threads_by_ids, missing_ids))
+
+            sling_updates = []
+            classified = []
+            for i, result in results.items():
+                message = messages_batch[i]
+                handled.add(i)
+                if result['action'] == 'sling':
+                    thread = threads.get(result['thread_id'])
+                    if thread and self._thread_allowed(thread, message, mixed):
+                        # Классификация сообщения в треде наследуется от треда
+                        sling_updates.append((message['message_id'], thread['thread_id'], thread['classification_id']))
+                    else:
+                        logger.warning(f"Тред {result['thread_id']} не найден в БД или в топике сообщения при слинге.")
+                        leftovers.append(message)
+                else:
+                    classified.append((message, result))
+
+            applied = await self.db.run(self.db.update_message_threads_bulk, sling_updates) if sling_updates else 0
+            applied += await self._apply_classification_results(classified)
+            await self._cache_put_many([(message['message_text'], result) for message, result in classified],
+                                       answered.get('model'))
+            stats['sling'] += len(sling_updates)
+            stats['classified'] += len(classified)
+            return applied
+
+        processed_count = 0
+        parser = JsonArrayStreamParser('results')
+        answered: Dict[str, str] = {}  # Модель, которая фактически отвечает
+        try:
+            prompt = await asyncio.to_thread(self._create_batch_combined_prompt, messages_batch, active_threads)
+            await self._rate_limiter.acquire()
+            async for chunk in self.ai_client.send_request_stream(prompt, json_mode=True, meta=answered):
+                ready = {}
+                for item in parser.feed(chunk):
+                    i, result = self._validate_combined_item(item)
+                    if i is not None and 0 <= i < len(messages_batch) and i not in handled:
+                        ready[i] = result
+                if ready:
+                    processed_count += await apply(ready)
+        except Exception as e:
+            logger.error(f"Ошибка совмещенного запроса слинга и классификации: {e}")
+            if not parser.items_seen:
+                return None
+
+        if not parser.items_seen:
+            # Потоком ничего не разобрано (не тот формат) - разбираем ответ целиком
+            results = await asyncio.to_thread(self._parse_batch_combined_response, parser.text)
+            results = {i: result for i, result in results.items() if 0 <= i < len(messages_batch)}
+            if not results:
+                logger.warning("Совмещенный ответ AI не разобран, переходим к раздельным слингу и классификации")
+                return None
+            processed_count += await apply(results)
+
+        leftovers.extend(message for i, message in enumerate(messages_batch) if i not in handled)
+        if leftovers:
+            processed_count += await self._batch_step3_new_entities(leftovers)
+
+        logger.debug(f"Совмещенный запрос: слинг {stats['sling']}, классификация {stats['classified']}, "
+                     f"отдельно {len(leftovers)}")
+        return processed_count
+
+    async def _batch_step2_semantic_sling(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> tuple[
+        List[tuple], List[ChatMessage]]:
+        """Пакетный семантический слинг.
+
+        Возвращает обновления для привязанных к тредам сообщений (message_id, thread_id, classification_id)
+        и оставшиеся сообщения; запись обновлений в БД выполняет вызывающий код
+        """
+        if not messages_batch or not active_threads:
+            logger.info("Пропуск слинга: нет сообщений или активных тредов.")
+            return [], messages_batch
+
+        try:
+            # Создаем пакетный запрос для всех сообщений (сборка промпта и разбор ответа - вне event loop)
+            batch_prompt = await asyncio.to_thread(self._create_batch_sling_prompt, messages_batch, active_threads)
+            async with self._rate_limiter:
+                response = await self.ai_client.send_request_with_retry(batch_prompt, json_mode=True)
+
+            # Парсим ответ и применяем результаты
+            sling_results = await asyncio.to_thread(self._parse_batch_sling_response, response)
+
+            # Треды, к которым AI привязал сообщения, ищем среди уже загруженных активных тредов,
+            # а недостающие (например, ID, которого не было в промпте) получаем из БД одним запросом
+            mixed = self._is_mixed_batch(messages_batch)
+            threads = {thread['thread_id']: thread for thread in active_threads}
+            missing_ids = {r['thread_id'] for r in sling_results
+                           if r['related'] and r['thread_id'] and r['thread_id'] not in threads}
+            if missing_ids:
+                threads.update((thread['thread_id'], thread)
+                               for thread in await self.db.run(self.db.get_threads_by_ids, missing_ids))
+
+            updates = []
+            remaining_messages = []
+
+            for i, message in enumerate(messages_batch):
+                if i < len(sling_results) and sling_results[i]['related'] and sling_results[i]['thread_id']:
+                    # Получаем информацию о треде, к которому привязываем
+                    thread = threads.get(sling_results[i]['thread_id'])
+                    if thread and self._thread_allowed(thread, message, mixed):
+                        # Привязываем сообщение к найденному треду, используя его классификацию
+                        # Классификация сообщения в треде наследуется от треда
+                        updates.append((
+                            message['message_id'],
+                            sling_results[i]['thread_id'],
+                            thread['classification_id'] # <-- Классификация наследуется от треда
+                        ))
+                        logger.debug(
+                            f"Пакетный слинг: сообщение {message['message_id']} → тред {sling_results[i]['thread_id']} (классификация: {thread['classification_id']})")
+                    else:
+                        logger.warning(f"Тред {sling_results[i]['thread_id']} не найден в БД или в топике сообщения при слинге.")
+                        remaining_messages.append(message)
+                else:
+                    # Если AI не нашел связи, оставляем сообщение для дальнейшей классификации
+                    remaining_messages.append(message)
+
+            logger.debug(f"Шаг 2: пакетный слинг привязал к тредам: {len(updates)}")
+            return updates, remaining_messages
+
+        except Exception as e:
+            logger.error(f"Ошибка пакетного слинга: {e}")
+            return [], messages_batch
+
+    async def _batch_step3_new_entities(self, messages_batch: List[ChatMessage]) -> int:
+        """Пакетная классификация новых сущностей.
+
+        Тривиальные сообщения сюда не попадают - их уже пометил process_batch
+        """
+        if not messages_batch:
+            return 0
+
+        processed_count = 0
+        done_ids = set()  # Сообщения, результат по которым уже записан в БД
+        try:
+            # Одинаковые (после нормализации) тексты классифицируем один раз: берем первого представителя группы,
+            # остальные получают тот же результат и привязываются к тому же треду
+            groups: Dict[str, List[ChatMessage]] = {}
+            for message in messages_batch:
+                groups.setdefault(self._cache_key(message['message_text']), []).append(message)
+            candidates = [group[0] for group in groups.values()]
+            duplicates = {group[0]['message_id']: group[1:] for group in groups.values() if len(group) > 1}
+            if duplicates:
+                logger.debug(f"Шаг 3: дубликатов текста в пакете: {sum(len(d) for d in duplicates.values())}")
+
+            def mark_done(items: List[tuple]):
+                for message, _ in items:
+                    done_ids.add(message['message_id'])
+                    done_ids.update(duplicate['message_id'] for duplicate in duplicates.get(message['message_id'], ()))
+
+            # Сообщения, которые уже классифицировались раньше, берем из кэша без обращения к AI
+            resolved, misses = await self._lookup_cached(candidates)
+
+            if resolved:
+                processed_count += await self._apply_classification_results(resolved, duplicates)
+                mark_done(resolved)
+                logger.debug(f"Шаг 3: из кэша классифицировано: {len(resolved)}")
+            if not misses:
+                return processed_count
+
+            # Ответ AI читаем потоком: готовые результаты пишем в БД, не дожидаясь конца генерации
+            batch_prompt = await asyncio.to_thread(self._create_batch_classification_prompt, misses)
+            parser = JsonArrayStreamParser('results')
+            to_cache = []
+            answered: Dict[str, str] = {}  # Модель, которая фактически отвечает - она идет в ключ кэша
+
+            await self._rate_limiter.acquire()
+            async for chunk in self.ai_client.send_request_stream(batch_prompt, json_mode=True, meta=answered):
+                ready = []
+                for item in parser.feed(chunk):
+                    index, result = self._validate_classification_item(item)
+                    if index is None or not 0 <= index < len(misses) or misses[index]['message_id'] in done_ids:
+                        continue
+                    ready.append((misses[index], result))
+                if ready:
+                    processed_count += await self._apply_classification_results(ready, duplicates)
+                    mark_done(ready)
+                    to_cache.extend((message['message_text'], result) for message, result in ready)
+
+            # Если ответ не удалось разобрать потоком (не тот формат), разбираем его целиком
+            leftovers = [None] * len(misses) if parser.items_seen else await asyncio.to_thread(
+                self._parse_batch_classification_response, parser.text, len(misses))
+            remaining = []
+            for message, result in zip(misses, leftovers):
+                if message['message_id'] in done_ids:
+                    continue
+                if result is not None:
+                    to_cache.append((message['message_text'], result))
+                else:
+                    # Если AI пропустил индекс сообщения, помечаем как 'other'
+                    result = ClassificationResult(classification='other', confidence=0.0, title=None)
+                    logger.warning(f"Нет результата классификации для сообщения {message['message_id']}, помечено как 'other'.")
+                remaining.append((message, result))
+            processed_count += await self._apply_classification_results(remaining, duplicates)
+
+            await self._cache_put_many(to_cache, answered.get('model'))
+
+            logger.debug(f"Шаг 3: пакетная классификация обработала: {processed_count}")
+            return processed_count
+
+        except Exception as e:
+            logger.error(f"Ошибка пакетной классификации: {e}")
+            # Резервный вариант: индивидуальная обработка сообщений, результат по которым еще не записан
+            remaining = [message for message in messages_batch if message['message_id'] not in done_ids]
+            return processed_count + await self._fallback_individual_classification(remaining)
+
+    @staticmethod
+    def _is_trivial_other(text: str) -> bool:
+        """Сообщение заведомо не goal/blocker: слишком короткое, только эмодзи/пунктуация или короткая реакция"""
+        stripped = text.strip()
+        if len(stripped) < 4 or _NON_WORD_RE.fullmatch(stripped):
+            return True
+        return stripped.lower().rstrip('!.)') in _TRIVIAL_REPLIES
+
+    # === Кэш результатов классификации ===
+
+    async def _lookup_cached(self, messages: List[ChatMessage]) -> Tuple[List[tuple], List[ChatMessage]]:
+        """Результаты из кэша: пары (сообщение, результат) для найденных и список промахов"""
+        cached_results = await self._cache_get([message['message_text'] for message in messages])
+        resolved = []
+        misses = []
+        for message in messages:
+            result = cached_results.get(self._cache_key(message['message_text']))
+            if result is None:
+                # Нет точного совпадения - берем классификацию почти такого же текста (заголовок не переносится)
+                result = self.similarity_cache.lookup(message['message_text'], self._cache_namespace())
+            if result is None:
+                misses.append(message)
+            else:
+                resolved.append((message, result))
+        return resolved, misses
+
+    def _model_version(self) -> str:
+        """Основная модель, которой классифицируются сообщения (входит в ключ кэша)"""
+        return next(iter(self.ai_client.models.values()), '')
+
+    def _cache_namespace(self, model_version: Optional[str] = None) -> str:
+        """Схема ответа и модель: результаты из кэша переиспользуются только в их пределах"""
+        return f"{CLASSIFICATION_CACHE_SCHEMA}|{model_version or self._model_version()}"
+
+    def _cache_key(self, text: str, model_version: Optional[str] = None) -> str:
+        """Ключ кэша: sha256 от нормализованного текста, версии модели и схемы ответа.
+
+        model_version - модель, давшая ответ; по умолчанию основная (ее ответы и ищутся в кэше)
+        """
+        normalized = _WS_RE.sub(' ', text.strip().lower())
+        raw = f"{self._cache_namespace(model_version)}|{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def _cache_get(self, texts: List[str]) -> Dict[str, Dict]:
+        """Возвращает закэшированные результаты классификации для текстов (по ключу кэша)"""
+        return await self.db.run(
+            self.db.get_cached_classifications,
+            [self._cache_key(text) for text in texts],
+            self.cache_ttl_days
+        )
+
+    async def _cache_put(self, text: str, result: Dict, model_version: Optional[str] = None):
+        """Сохраняет результат классификации текста в кэш"""
+        await self._cache_put_many([(text, result)], model_version)
+
+    async def _cache_put_many(self, items: List[tuple], model_version: Optional[str] = None):
+        """Сохраняет в кэш пары (текст, результат) одной транзакцией.
+
+        model_version - модель, которая фактически ответила (запасная модель дает другой ключ)
+        """
+        # Заглушки для некорректных ответов AI (confidence 0) не кэшируем
+        items = [(text, result) for text, result in items
+                 if result.get('classification') and result.get('confidence', 0) > 0]
+        if not items:
+            return
+
+        model_version = model_version or self._model_version()
+        await self.db.run(self.db.save_cached_classifications, [
+            {
+                'cache_key': self._cache_key(text, model_version),
+                'classification': result['classification'],
+                'title': result.get('title'),
+                'confidence': result['confidence'],
+                'model_version': model_version
+            }
+            for text, result in items
+        ])
+        for text, result in items:
+            self.similarity_cache.add(text, result, self._cache_namespace(model_version))
+
+    def _create_batch_sling_prompt(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> str:
+        """Создает промпт для пакетного семантического слинга"""
+        threads_context = self._threads_context(self._relevant_threads(messages_batch, active_threads))
+
+        # Форматируем сообщения для классификации
+        mixed = self._is_mixed_batch(messages_batch)
+        messages_context = "".join(
+            f"{i + 1}. Сообщение ID {message['message_id']}{self._topic_label(message, mixed)}:\n"
+            f"   \"{self._prompt_text(message['message_text'], self.SLING_MESSAGE_TOKENS)}\"\n\n"
+            for i, message in enumerate(messages_batch)
+        )
+
+        return "".join((
+            self._SLING_PROMPT_HEADER, threads_context,
+            self._MIXED_TOPICS_NOTE if mixed else "",
+            "\n\nСООБЩЕНИЯ ДЛЯ АНАЛИЗА:\n", messages_context,
+            self._SLING_PROMPT_FOOTER
+        ))
+
+    def _relevant_threads(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> List[ActiveThread]:
+        """Треды для промпта: если их больше лимита, берутся самые релевантные сообщениям пакета по BM25.
+
+        Каждому сообщению достаются его лучшие треды; свободные места добираются свежими тредами
+        """
+        if len(active_threads) <= self.PROMPT_THREADS_LIMIT:
+            return active_threads
+
+        index = BM25Index([f"{thread['title'] or ''} {' '.join(thread.get('messages', []))}"
+                           for thread in active_threads])
+
+        selected: Dict[int, None] = {}  # Упорядоченное множество индексов тредов
+        rankings = [index.top(message['message_text'], self.RELEVANT_THREADS_PER_MESSAGE) for message in messages_batch]
+        # По кругу: сначала лучший тред каждого сообщения, потом второй и т.д.
+        for rank in range(self.RELEVANT_THREADS_PER_MESSAGE):
+            for ranking in rankings:
+                if rank < len(ranking) and len(selected) < self.PROMPT_THREADS_LIMIT:
+                    selected.setdefault(ranking[rank])
+        for i in range(len(active_threads)):
+            if len(selected) >= self.PROMPT_THREADS_LIMIT:
+                break
+            selected.setdefault(i)
+
+        # Сохраняем исходный порядок тредов (свежие выше)
+        return [active_threads[i] for i in sorted(selected)]
+
+    def _threads_context(self, active_threads: List[ActiveThread]) -> str:
+        """Текст контекста тредов для промптов"""
+        # Форматируем треды для контекста, теперь включая *все* сообщения треда
+        # (ограничиваем количество тредов для контекста)
+        return "".join(
+            f"{i + 1}. Тред #{thread['thread_id']} ("
+            f"{'Топик ' + str(thread['topic_id']) + ', ' if 'topic_id' in thread else ''}"
+            f"Классификация: {thread['classification_id']}):\n"
+            f"   Заголовок: {thread['title']}\n"
+            f"   Контекст (все сообщения): {self._thread_preview(thread.get('messages', []))}\n\n"
+            for i, thread in enumerate(active_threads[:self.PROMPT_THREADS_LIMIT])
+        )
+
+    def _create_batch_combined_prompt(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> str:
+        """Создает совмещенный промпт: привязка к существующему треду или классификация новой сущности"""
+        mixed = self._is_mixed_batch(messages_batch)
+        messages_context = "".join(
+            f"{i}.{self._topic_label(message, mixed)} "
+            f"\"{self._prompt_text(message['message_text'], self.CLASSIFICATION_MESSAGE_TOKENS)}\"\n"
+            for i, message in enumerate(messages_batch)
+        )
+        return "".join((
+            self._COMBINED_PROMPT_HEADER, self._threads_context(self._relevant_threads(messages_batch, active_threads)),
+            self._MIXED_TOPICS_NOTE if mixed else "",
+            "\n\nСООБЩЕНИЯ ДЛЯ АНАЛИЗА (номер - message_index):\n", messages_context,
+            self._COMBINED_PROMPT_FOOTER
+        ))
+
+    @staticmethod
+    def _topic_label(message: ChatMessage, mixed: bool) -> str:
+        """Пометка топика сообщения в промпте общего пакета"""
+        return f" (Топик {message.get('topic_id')})" if mixed else ""
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _prompt_text(text: str, max_tokens: int) -> str:
+        """Текст сообщения для промпта без вежливых вставок, обрезанный до max_tokens.
+
+        Одно и то же сообщение может попасть в несколько промптов (совмещенный, слинг, классификация)
+        и в повторные попытки - подготовленный текст берется из кэша
+        """
+        return truncate_tokens(strip_filler(text), max_tokens)
+
+    @staticmethod
+    def _thread_preview(thread_messages: List[str], limit: int = 300) -> str:
+        """Превью треда: сообщения через пробел, обрезанные до limit символов.
+
+        Склеиваются только сообщения, попадающие в превью, а не весь тред
+        """
+        if not thread_messages:
+            return "Тред без сообщений."
+
+        parts = []
+        length = -1
+        for text in thread_messages:
+            parts.append(text)
+            length += len(text) + 1
+            if length > limit:
+                return " ".join(parts)[:limit] + "..."
+        return " ".join(parts)
+
+    def _create_batch_classification_prompt(self, messages_batch: List[ChatMessage]) -> str:
+        """Создает промпт для пакетной классификации"""
+
+        messages_context = "".join(
+            f"{i + 1}. \"{self._prompt_text(message['message_text'], self.CLASSIFICATION_MESSAGE_TOKENS)}\"\n"
+            for i, message in enumerate(messages_batch)
+        )
+
+        return "".join((self._CLASSIFICATION_PROMPT_HEADER, messages_context, self._CLASSIFICATION_PROMPT_FOOTER))
+
+    @staticmethod
+    def _load_json_response(response: str) -> Dict:
+        """Снимает markdown-обрамление с ответа AI и разбирает JSON"""
+        return json.loads(_FENCE_RE.sub('', response))
+
+    @staticmethod
+    def _validate_combined_item(item: Dict) -> Tuple[Optional[int], Optional[CombinedResult]]:
+        """Проверяет один результат совмещенного запроса: (message_index, результат); (None, None) - пропустить"""
+        action = item.get('action')
+        if 'message_index' not in item or action not in ('sling', 'new', 'other'):
+            logger.warning(f"Некорректный результат совмещенного запроса пропущен: {item}")
+            return None, None
+        if action == 'sling' and not item.get('thread_id'):
+            logger.warning(f"Слинг без thread_id пропущен: {item}")
+            return None, None
+        return int(item['message_index']), CombinedResult(
+            action=action,
+            thread_id=item.get('thread_id') if action == 'sling' else None,
+            classification=(item.get('classification') or 'other') if action == 'new' else 'other',
+            confidence=float(item.get('confidence') or 0.0),
+            title=item.get('title')
+        )
+
+    def _parse_batch_combined_response(self, response: str) -> Dict[int, CombinedResult]:
+        """Парсит ответ совмещенного запроса: {message_index: результат}; пустой словарь - ответ не разобран"""
+        try:
+            data = self._load_json_response(response)
+            validated_results = {}
+            for item in data.get('results', []):
+                index, result = self._validate_combined_item(item)
+                if index is not None:
+                    validated_results[index] = result
+            return validated_results
+
+        except Exception as e:
+            logger.error(f"Ошибка парсинга совмещенного ответа: {e}, ответ: {response}")
+            return {}
+
+    def _parse_batch_sling_response(self, response: str) -> List[SlingResult]:
         """Парсит ответ пакетного слинга"""
         try:
-            # Очищаем ответ от возможных лишних символов
-            cleaned_response = response.strip()
-            if cleaned_response.startswith('```json'):
-                cleaned_response = cleaned_response[7:]
-            if cleaned_response.endswith('```'):
-                cleaned_response = cleaned_response[:-3]
-            cleaned_response = cleaned_response.strip()
-
-            # Парсим JSON
-            data = json.loads(cleaned_response)
+            data = self._load_json_response(response)
             results = data.get('results', [])
 
             # Валидируем результаты
             validated_results = []
             for result in results:
-                if all(key in result for key in ['message_id', 'related', 'thread_id', 'confidence']):
-                    validated_results.append({
-                        'message_id': result['message_id'],
-                        'related': bool(result['related']),
-                        'thread_id': result['thread_id'] if result['thread_id'] else None,
-                        'confidence': float(result['confidence'])
-                    })
+                message_id = result.get('message_id')
+                related = result.get('related')
+                confidence = result.get('confidence')
+                if message_id is not None and related is not None and confidence is not None:
+                    validated_results.append(SlingResult(
+                        message_id=message_id,
+                        related=bool(related),
+                        thread_id=result.get('thread_id') or None,
+                        confidence=float(confidence)
+                    ))
                 else:
                     logger.warning(f"Некорректный результат слинга: {result}. Помечено как unrelated.")
-                    validated_results.append({
-                        'message_id': 0, # или None, если message_id неизвестен
-                        'related': False,
-                        'thread_id': None,
-                        'confidence': 0.0
-                    })
+                    # message_id неизвестен - 0
+                    validated_results.append(SlingResult(message_id=0, related=False, thread_id=None, confidence=0.0))
 
             return validated_results
 
@@ -357,128 +1015,152 @@ class ClassificationService:
             logger.error(f"Ошибка парсинга ответа слинга: {e}")
             return []
 
-    def _parse_batch_classification_response(self, response: str) -> List[Dict]:
-        """Парсит ответ пакетной классификации"""
+    @staticmethod
+    def _validate_classification_item(item: Dict) -> Tuple[Optional[int], Optional[ClassificationResult]]:
+        """Проверяет один результат классификации из ответа AI: (message_index, результат)"""
+        index = item.get('message_index')
+        if index is None:
+            logger.warning(f"Результат классификации без message_index пропущен: {item}")
+            return None, None
+        classification = item.get('classification')
+        confidence = item.get('confidence')
+        if classification is not None and confidence is not None:
+            return int(index), ClassificationResult(
+                classification=classification,
+                confidence=float(confidence),
+                title=item.get('title')
+            )
+        logger.warning(f"Некорректный результат классификации: {item}. Помечено как 'other'.")
+        return int(index), ClassificationResult(classification='other', confidence=0.0, title=None)
+
+    def _parse_batch_classification_response(self, response: str,
+                                             expected_len: int) -> List[Optional[ClassificationResult]]:
+        """Парсит ответ пакетной классификации: список длины expected_len, None - результата для сообщения нет"""
+        validated_results: List[Optional[ClassificationResult]] = [None] * expected_len
         try:
-            # Очищаем ответ
-            cleaned_response = response.strip()
-            if cleaned_response.startswith('```json'):
-                cleaned_response = cleaned_response[7:]
-            if cleaned_response.endswith('```'):
-                cleaned_response = cleaned_response[:-3]
-            cleaned_response = cleaned_response.strip()
-
-            # Парсим JSON
-            data = json.loads(cleaned_response)
-            results = data.get('results', [])
-
-            # Валидируем и сортируем результаты
-            validated_results = []
-            for result in sorted(results, key=lambda x: x.get('message_index', 0)):
-                if all(key in result for key in ['message_index', 'classification', 'confidence']):
-                    validated_results.append({
-                        'classification': result['classification'],
-                        'confidence': float(result['confidence']),
-                        'title': result.get('title')
-                    })
-                else:
-                    logger.warning(f"Некорректный результат классификации: {result}. Помечено как 'other'.")
-                    validated_results.append({
-                        'classification': 'other',
-                        'confidence': 0.0,
-                        'title': None
-                    })
+            data = self._load_json_response(response)
 
-            return validated_results
+            # Валидируем результаты и раскладываем по индексу сообщения
+            for item in data.get('results', []):
+                index, result = self._validate_classification_item(item)
+                if index is not None and 0 <= index < expected_len:
+                    validated_results[index] = result
 
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка парсинга JSON классификации: {e}, ответ: {response}")
-            # Пытаемся извлечь данные с помощью regex как запасной вариант
-            return self._parse_with_regex(response)
+            # Пытаемся извлечь данные с помощью regex как запасной вариант (результаты идут по порядку)
+            parsed = self._parse_with_regex(response)[:expected_len]
+            validated_results[:len(parsed)] = parsed
         except Exception as e:
             logger.error(f"Ошибка парсинга ответа классификации: {e}")
-            return []
 
-    def _parse_with_regex(self, response: str) -> List[Dict]:
+        return validated_results
+
+    def _parse_with_regex(self, response: str) -> List[ClassificationResult]:
         """Резервный парсинг с помощью regex"""
         try:
             results = []
+            current = None
+
+            # Поля идут по порядку объектов: повтор уже встреченного поля означает начало следующего результата
+            for match in _RESULT_FIELD_RE.finditer(response):
+                field, raw_value = match.groups()
+                if current is None or field in current:
+                    current = {}
+                    results.append(current)
+                if raw_value == 'null':
+                    current[field] = None
+                elif raw_value.startswith('"'):
+                    current[field] = raw_value[1:-1]
+                else:
+                    current[field] = raw_value
 
-            # Ищем classification паттерны
-            classification_pattern = r'"classification":\s*"(\w+)"'
-            confidence_pattern = r'"confidence":\s*([0-9.]+)'
-            title_pattern = r'"title":\s*"([^"]*)"'
-
-            classifications = re.findall(classification_pattern, response)
-            confidences = re.findall(confidence_pattern, response)
-            titles = re.findall(title_pattern, response)
-
-            for i in range(max(len(classifications), len(confidences))):
-                classification = classifications[i] if i < len(classifications) else 'other'
-                confidence = float(confidences[i]) if i < len(confidences) else 0.5
-                title = titles[i] if i < len(titles) else None
-
-                results.append({
-                    'classification': classification,
-                    'confidence': confidence,
-                    'title': title
-                })
+            results = [
+                ClassificationResult(
+                    classification=fields.get('classification') or 'other',
+                    confidence=float(fields['confidence']) if fields.get('confidence') else 0.5,
+                    title=fields.get('title')
+                )
+                for fields in results
+                if 'classification' in fields or 'confidence' in fields
+            ]
 
             logger.warning(f"Использован резервный парсинг regex для классификации. Результаты: {results}")
-            return results[:10]  # Ограничиваем количество результатов
+            return results
 
         except Exception as e:
             logger.error(f"Ошибка regex парсинга: {e}")
             return []
 
-    async def _apply_classification_result(self, message: Dict, result: Dict) -> bool:
-        """Применяет результат классификации к сообщению"""
-        try:
-            if result['classification'] in ['goal', 'blocker'] and result['confidence'] > 0.6:
-                title = result['title'] or message['message_text'][:50]
-                # Создаем новый тред с классификацией, определенной AI
-                thread_id = self.db.create_thread(title, result['classification'])
+    async def _apply_classification_results(self, results: List[Tuple[Dict, ClassificationResult]],
+                                            duplicates: Dict[int, List[ChatMessage]] = None) -> int:
+        """Применяет результаты классификации к сообщениям: пары (сообщение, результат).
 
-                if thread_id > 0:
-                    # Привязываем сообщение к новому треду, устанавливая его классификацию
-                    self.db.update_message_thread(
-                        message['message_id'],
-                        thread_id,
-                        result['classification'] # <-- Классификация устанавливается из результата AI
-                    )
-                    logger.debug(f"Создан тред {thread_id} (классификация: {result['classification']}) для сообщения {message['message_id']}")
-                    return True
+        Новые треды для goal/blocker создаются одной транзакцией, привязка сообщений - одним executemany.
+        duplicates - сообщения с тем же текстом по message_id представителя: они получают тот же тред
+        """
+        try:
+            new_threads = []  # (сообщение, результат) для которых нужен новый тред
+            updates = []
+            for message, result in results:
+                if result['classification'] in ['goal', 'blocker'] and result['confidence'] > 0.6:
+                    new_threads.append((message, result))
                 else:
-                    logger.error(f"Ошибка создания треда для сообщения {message['message_id']}")
-                    return False
-            else:
-                # Если классификация 'other' или уверенность низкая, не создаем тред
-                self.db.update_message_thread(message['message_id'], None, 'other')
-                logger.debug(f"Сообщение {message['message_id']} помечено как 'other', тред не создан.")
-                return True
+                    # Если классификация 'other' или уверенность низкая, не создаем тред
+                    updates.append((message['message_id'], None, 'other'))
+                    logger.debug(f"Сообщение {message['message_id']} помечено как 'other', тред не создан.")
+
+            thread_ids = await self.db.run(self.db.create_threads_bulk, [
+                (result['title'] or message['message_text'][:50], result['classification'])
+                for message, result in new_threads
+            ])
+            if thread_ids:
+                self._invalidate_threads_cache({message.get('topic_id') for message, _ in new_threads})
+            for (message, result), thread_id in zip(new_threads, thread_ids):
+                # Привязываем сообщение к новому треду, устанавливая его классификацию из результата AI
+                updates.append((message['message_id'], thread_id, result['classification']))
+                logger.debug(f"Создан тред {thread_id} (классификация: {result['classification']}) для сообщения {message['message_id']}")
+            if len(thread_ids) < len(new_threads):
+                logger.error(f"Ошибка создания тредов: создано {len(thread_ids)} из {len(new_threads)}")
+
+            if duplicates:
+                updates += [
+                    (duplicate['message_id'], thread_id, classification)
+                    for message_id, thread_id, classification in updates
+                    for duplicate in duplicates.get(message_id, ())
+                ]
+
+            return await self.db.run(self.db.update_message_threads_bulk, updates)
 
         except Exception as e:
             logger.error(f"Ошибка применения классификации: {e}")
-            return False
+            return 0
+
+    async def _fallback_individual_processing(self, messages_batch: List[ChatMessage], active_threads: List[ActiveThread]) -> int:
+        """Резервная индивидуальная обработка при ошибке пакетной (параллельно, не более max_concurrency запросов)"""
+        async def _one(message: ChatMessage):
+            # В общем пакете сообщению доступны только треды его топика
+            message_threads = [thread for thread in active_threads
+                               if thread.get('topic_id', message.get('topic_id')) == message.get('topic_id')]
+            async with self._individual_semaphore:
+                return await self.three_step_classification(message, message_threads)
+
+        results = await asyncio.gather(*[_one(message) for message in messages_batch], return_exceptions=True)
 
-    async def _fallback_individual_processing(self, messages_batch: List[Dict], active_threads: List[Dict]) -> int:
-        """Резервная индивидуальная обработка при ошибке пакетной"""
         processed_count = 0
-        for message in messages_batch:
-            try:
-                await self.three_step_classification(message, active_threads)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка индивидуальной классификации: {result}")
+            else:
                 processed_count += 1
-                await asyncio.sleep(0.1)  # Небольшая пауза между запросами
-            except Exception as e:
-                logger.error(f"Ошибка индивидуальной классификации: {e}")
         return processed_count
 
-    async def _fallback_individual_classification(self, messages_batch: List[Dict]) -> int:
+    async def _fallback_individual_classification(self, messages_batch: List[ChatMessage]) -> int:
         """Резервная индивидуальная классификация"""
         return await self._fallback_individual_processing(messages_batch, [])
 
     # Старые методы для обратной совместимости и индивидуальной обработки
-    async def three_step_classification(self, message_data: Dict, active_threads: List[Dict]):
+    async def three_step_classification(self, message_data: ChatMessage, active_threads: List[ActiveThread]):
         """Индивидуальная трехступенчатая классификация"""
         try:
             message_id = message_data['message_id']
@@ -487,7 +1169,7 @@ class ClassificationService:
             logger.debug(f"Индивидуальная классификация сообщения {message_id}")
 
             # Шаг 1: Проверка ответа/реплая
-            if await self._step1_check_reply(message_data):
+            if await self.db.run(self._step1_check_reply, message_data):
                 return
 
             # Шаг 2: Семантический слинг
@@ -500,8 +1182,8 @@ class ClassificationService:
         except Exception as e:
             logger.error(f"Ошибка трехступенчатой классификации для сообщения {message_data['message_id']}: {e}")
 
-    async def _step1_check_reply(self, message_data: Dict) -> bool:
-        """Шаг 1: Проверка ответа/реплая"""
+    def _step1_check_reply(self, message_data: ChatMessage) -> bool:
+        """Шаг 1: Проверка ответа/реплая (только запросы к БД, без AI)"""
         try:
             if message_data.get('parent_message_id'):
                 parent_thread = self.db.get_message_thread_by_parent(message_data['parent_message_id'])
@@ -520,18 +1202,20 @@ class ClassificationService:
             logger.error(f"Ошибка в шаге 1 для сообщения {message_data['message_id']}: {e}")
             return False
 
-    async def _step2_semantic_sling(self, message_data: Dict, message_text: str, active_threads: List[Dict]) -> bool:
+    async def _step2_semantic_sling(self, message_data: ChatMessage, message_text: str, active_threads: List[ActiveThread]) -> bool:
         """Шаг 2: Семантический слинг (индивидуальный вызов, если пакетный не используется)"""
         try:
             # Используем индивидуальный вызов AI клиента, если пакетный не сработал
             # ВАЖНО: Этот метод (semantic_sling_schema_c) должен быть реализован в ai_client
             # и использовать обновленную логику, аналогичную пакетному промпту
-            sling_result = await self.ai_client.semantic_sling_schema_c(message_text, active_threads)
+            async with self._rate_limiter:
+                sling_result = await self.ai_client.semantic_sling_schema_c(message_text, active_threads)
             if sling_result.get('related') and sling_result.get('thread_id'):
-                thread = self.db.get_thread_by_id(sling_result['thread_id'])
+                thread = await self.db.run(self.db.get_thread_by_id, sling_result['thread_id'])
                 if thread:
                     # Привязываем сообщение к найденному треду, используя его классификацию
-                    self.db.update_message_thread(
+                    await self.db.run(
+                        self.db.update_message_thread,
                         message_data['message_id'],
                         sling_result['thread_id'],
                         thread['classification_id']
@@ -544,21 +1228,29 @@ class ClassificationService:
             logger.error(f"Ошибка в шаге 2 для сообщения {message_data['message_id']}: {e}")
             return False
 
-    async def _step3_new_entity_classification(self, message_data: Dict, message_text: str):
+    async def _step3_new_entity_classification(self, message_data: ChatMessage, message_text: str):
         """Шаг 3: Классификация новой сущности (индивидуальный вызов)"""
         try:
-            # Используем индивидуальный вызов AI клиента
-            # ВАЖНО: Этот метод (classify_message_schema_b) должен быть реализован в ai_client
-            # и использовать обновленную логику, аналогичную пакетному промпту
-            classification_result = await self.ai_client.classify_message_schema_b(message_text)
+            classification_result: Optional[Dict] = (await self._cache_get([message_text])).get(self._cache_key(message_text))
+            if classification_result is None:
+                # Используем индивидуальный вызов AI клиента
+                # ВАЖНО: Этот метод (classify_message_schema_b) должен быть реализован в ai_client
+                # и использовать обновленную логику, аналогичную пакетному промпту
+                answered: Dict[str, str] = {}
+                async with self._rate_limiter:
+                    classification_result = await self.ai_client.classify_message_schema_b(message_text, meta=answered)
+                await self._cache_put(message_text, classification_result, answered.get('model'))
             if classification_result.get('classification') in ['goal', 'blocker']:
-                thread_id = self.db.create_thread(
+                thread_id = await self.db.run(
+                    self.db.create_thread,
                     classification_result.get('title') or message_text[:50],
                     classification_result['classification']
                 )
                 if thread_id > 0:
+                    self._invalidate_threads_cache({message_data.get('topic_id')})
                     # Привязываем сообщение к новому треду, устанавливая его классификацию
-                    self.db.update_message_thread(
+                    await self.db.run(
+                        self.db.update_message_thread,
                         message_data['message_id'],
                         thread_id,
                         classification_result['classification']
@@ -567,7 +1259,7 @@ class ClassificationService:
                 else:
                     logger.error(f"Ошибка создания треда для сообщения {message_data['message_id']}")
             else:
-                self.db.update_message_thread(message_data['message_id'], None, 'other')
+                await self.db.run(self.db.update_message_thread, message_data['message_id'], None, 'other')
                 logger.info(f"Сообщение {message_data['message_id']} помечено как 'other' (индивидуальная классификация)")
         except Exception as e:
             logger.error(f"Ошибка в шаге 3 для сообщения {message_data['message_id']}: {e}")
@@ -575,8 +1267,7 @@ class ClassificationService:
     def get_classification_stats(self) -> Dict:
         """Возвращает статистику по классификации"""
         try:
-            total_messages = len(self.db.get_messages_for_period(days=30))
-            unprocessed = len(self.db.get_unprocessed_messages())
+            total_messages, unprocessed = self.db.get_classification_counts(days=30)
             processed = total_messages - unprocessed
 
             return {
@@ -584,7 +1275,8 @@ class ClassificationService:
                 "processed": processed,
                 "unprocessed": unprocessed,
                 "processing_rate": f"{(processed / total_messages * 100):.1f}%" if total_messages > 0 else "0%",
-                "batch_size": self.batch_size
+                "batch_size": self.batch_size,
+                "concurrent_batches": self.concurrent_batches
             }
         except Exception as e:
             logger.error(f"Ошибка получения статистики классификации: {e}")
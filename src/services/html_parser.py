@@ -1,28 +1,102 @@
 # services/html_parser.py
+import asyncio
 import logging
+import time
 from datetime import datetime
-from typing import Dict, Optional, Any, List
-from bs4 import BeautifulSoup, Tag
+from functools import lru_cache
+from typing import Dict, Optional, Any, List, Set, Union, BinaryIO
+from lxml import etree
 import re
 
 logger = logging.getLogger(__name__)
 
+# Регулярные выражения компилируются один раз на модуль, а не на каждое сообщение
+_TOPIC_HREF_RE = re.compile(r'topic[_-]?(\d+)', re.IGNORECASE)
+_TOPIC_TEXT_RE = re.compile(r'топик[_\s]*(\d+)', re.IGNORECASE)
+_GOTO_MESSAGE_RE = re.compile(r'go_to_message\((\d+)\)')
+_MESSAGE_HREF_RE = re.compile(r'message[_-]?(\d+)', re.IGNORECASE)
+
+# Сервисное сообщение о создании топика: «название» после фразы (группа 1) или перед ней (группа 2)
+_TOPIC_CREATED_RE = re.compile(
+    r'(?:created topic|создал\(а\)\s+топик)\s+«([^»]+)»|'
+    r'(?:topic|топик)\s+«([^»]+)»\s+(?:created|создан)',
+    re.IGNORECASE
+)
+
+# Сервисное сообщение о переименовании топика
+_TOPIC_RENAMED_RE = re.compile(
+    r'(?:changed topic title to|изменил\(а\)\s+название\s+топика\s+на|переименовал\(а\)\s+топик\s+в|'
+    r'topic title changed to|название\s+топика\s+изменено\s+на)\s+«([^»]+)»',
+    re.IGNORECASE
+)
+
+# Ссылки внутри блока реплая (class="reply_to details"): выборка целиком выполняется в lxml, без обхода в Python
+_REPLY_HREFS_XPATH = etree.XPath('.//*[contains(concat(" ", normalize-space(@class), " "), " reply_to ")]//a/@href')
+
+
+def _message_div_number(div_id: str) -> Optional[int]:
+    """
+    Номер сообщения из id вида message123 или message-123, иначе None
+
+    Префикс проверяется строкой, регулярка на каждый div не нужна
+    """
+    if not div_id.startswith('message'):
+        return None
+    number = div_id[7:].removeprefix('-')
+    if number.isascii() and number.isdigit():
+        return int(number)
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _parse_export_datetime(title: str) -> datetime:
+    """
+    Дата из атрибута title вида '31.12.2024 23:59:59 UTC+03:00' без strptime
+
+    Сообщения одной пачки часто приходятся на одну секунду, поэтому результат кэшируется
+    """
+    if len(title) != 29 or title[2] != '.' or title[5] != '.' or title[10] != ' ' \
+            or title[13] != ':' or title[16] != ':' or title[19:] != ' UTC+03:00':
+        raise ValueError(f"Неизвестный формат даты: {title!r}")
+    return datetime(int(title[6:10]), int(title[3:5]), int(title[0:2]),
+                    int(title[11:13]), int(title[14:16]), int(title[17:19]))
+
+
+def _classes(element: etree._Element) -> List[str]:
+    """Классы элемента"""
+    return (element.get('class') or '').split()
+
+
+def _find_div(element: etree._Element, class_name: str) -> Optional[etree._Element]:
+    """Первый вложенный div с классом class_name"""
+    for div in element.iterdescendants('div'):
+        if class_name in _classes(div):
+            return div
+    return None
+
+
+def _text(element: etree._Element) -> str:
+    """Текст элемента: фрагменты без окружающих пробелов, склеенные подряд"""
+    return ''.join(fragment.strip() for fragment in element.itertext())
+
 
 class HTMLParserService:
+    SAVE_BATCH_SIZE = 1000  # Сколько сообщений сохраняется в БД одной транзакцией
+
     def __init__(self, db) -> None:
         self.db = db
 
-    async def parse_html_file(self, file_path: str) -> Dict[str, Any]:
+    async def parse_html_file(self, file_path: Union[str, BinaryIO]) -> Dict[str, Any]:
         """
         Парсит HTML файл с историей чата Telegram и сохраняет сообщения в БД
-        """
-        try:
-            start_time = datetime.now()
 
-            with open(file_path, 'r', encoding='utf-8') as file:
-                html_content = file.read()
+        file_path - путь к файлу или открытый бинарный файл (например, BytesIO со скачанным документом)
 
-            soup = BeautifulSoup(html_content, 'html.parser')
+        Файл разбирается потоково: каждое сообщение обрабатывается, как только закрывается его div,
+        и сразу освобождается, поэтому дерево всего файла в памяти не строится
+        """
+        try:
+            start_time = time.perf_counter()
 
             # Собираем статистику
             stats: Dict[str, Any] = {
@@ -34,49 +108,95 @@ class HTMLParserService:
                 'error': None
             }
 
-            # Ищем все сообщения (обычные и сервисные)
-            messages = soup.find_all('div', id=re.compile(r'^message-?\d+$'))
-            stats['total_messages'] = len(messages)
-
-            if not messages:
-                stats['error'] = "Не найдено сообщений в файле"
-                return stats
+            # Сервисные сообщения о создании и переименовании топиков собираются по ходу прохода:
+            # реплай в экспорте всегда идет после сообщения, на которое отвечает
+            topic_creation_messages: Dict[int, Dict[str, Any]] = {}
+            # ID сервисных сообщений, уже встреченных в файле; свои для каждого вызова -
+            # несколько файлов могут разбираться одновременно
+            service_message_ids: Set[int] = set()
 
-            # Сначала собираем все сервисные сообщения о создании и переименовании топиков
-            topic_creation_messages = self._extract_topic_creation_messages(messages)
+            # Топики-источники читаем из БД один раз на файл: {название в нижнем регистре: topic_id}
+            source_topics = await self.db.run(self.db.get_source_topics)
+            topic_index: Dict[str, int] = {}
+            for topic in source_topics:
+                if topic['topic_name']:
+                    topic_index.setdefault(topic['topic_name'].lower(), topic['topic_id'])
 
             current_topic_id: Optional[int] = None
             saved_count = 0
+            batch: List[Dict[str, Any]] = []  # Сообщения, ожидающие пакетной записи в БД
+            # Пачка, которая пишется в БД в фоновом потоке, пока разбираются следующие сообщения
+            pending_save: Optional[asyncio.Future] = None
+
+            # Ищем все сообщения (обычные и сервисные)
+            for _, message in etree.iterparse(file_path, events=('end',), tag='div', html=True, encoding='utf-8'):
+                # Номер сообщения вычисляется один раз и передается дальше
+                message_id = _message_div_number(message.get('id') or '')
+                if message_id is None:
+                    continue
+                stats['total_messages'] += 1
 
-            for message in messages:
                 try:
+                    service_topic_name = None
+                    is_service = self._is_service_message(message)
+                    if is_service:
+                        service_message_ids.add(message_id)
+                        service_topic_name = self._register_topic_service_message(
+                            message, message_id, topic_creation_messages
+                        )
+
+                    # Реплай ищется один раз: он нужен и для topic_id, и для самого сообщения
+                    parent_message_id = self._extract_parent_message_id(message)
+
                     # Определяем topic_id из структуры сообщения
-                    topic_id = self._extract_topic_id(message, topic_creation_messages)
+                    topic_id = self._extract_topic_id(
+                        message, parent_message_id, topic_creation_messages, topic_index, service_topic_name
+                    )
                     if topic_id:
                         current_topic_id = topic_id
                         stats['topics_found'].add(topic_id)
 
-                    # Парсим данные сообщения
-                    message_data = self._parse_message(message, current_topic_id)
+                    # Парсим данные сообщения (сервисные сообщения пропускаем)
+                    message_data = None if is_service else self._parse_message(
+                        message, message_id, parent_message_id, current_topic_id, service_message_ids
+                    )
                     if message_data and message_data.get('message_text'):
-                        # Сохраняем в БД
-                        if self.db.save_message(message_data):
-                            saved_count += 1
-                            logger.debug(
-                                f"Сообщение сохранено: {message_data['message_text'][:50]}... "
-                                f"(дата: {message_data['created_at']})"
-                            )
+                        batch.append(message_data)
+                        # Сохраняем в БД пачками, а не по одному сообщению
+                        if len(batch) >= self.SAVE_BATCH_SIZE:
+                            # В записи держим не больше одной пачки: дожидаемся предыдущей.
+                            # db.run отправляет запись в пул потоков БД сразу, не дожидаясь следующего await
+                            if pending_save is not None:
+                                saved_count += await pending_save
+                            pending_save = self.db.run(self.db.save_messages, batch)
+                            logger.debug(f"Отправлена на сохранение пачка сообщений: {len(batch)}")
+                            batch = []
 
                 except Exception as e:
                     logger.error(f"Ошибка парсинга сообщения: {e}")
-                    continue
+
+                finally:
+                    # Освобождаем разобранное сообщение и уже обработанные соседние узлы
+                    message.clear()
+                    while message.getprevious() is not None:
+                        del message.getparent()[0]
+
+            if pending_save is not None:
+                saved_count += await pending_save
+
+            if not stats['total_messages']:
+                stats['error'] = "Не найдено сообщений в файле"
+                stats['topics_found'] = 0
+                return stats
+
+            saved_count += await self.db.run(self.db.save_messages, batch)
 
             stats['saved_messages'] = saved_count
             stats['topics_found'] = len(stats['topics_found'])
-            stats['processing_time'] = (datetime.now() - start_time).total_seconds()
+            stats['processing_time'] = time.perf_counter() - start_time
             stats['success'] = True
 
-            logger.info(f"Парсинг завершен: {saved_count}/{len(messages)} сообщений сохранено")
+            logger.info(f"Парсинг завершен: {saved_count}/{stats['total_messages']} сообщений сохранено")
             return stats
 
         except Exception as e:
@@ -90,136 +210,108 @@ class HTMLParserService:
                 'processing_time': 0
             }
 
-    def _extract_topic_creation_messages(self, messages: List[Tag]) -> Dict[int, Dict[str, Any]]:
+    def _register_topic_service_message(self, message: etree._Element, message_id: int,
+                                        topic_messages: Dict[int, Dict[str, Any]]) -> Optional[str]:
         """
-        Извлекает из сервисных сообщений информацию о создании и переименовании топиков
+        Запоминает сервисное сообщение о создании или переименовании топика
+
+        topic_messages: {message_id: {'topic_name': str, 'created_at': datetime, 'type': 'creation'|'rename'}}
 
         Returns:
-            dict: {message_id: {'topic_name': str, 'created_at': datetime, 'type': 'creation'|'rename'}}
+            str: актуальное название топика из сообщения (новое, если топик переименован) или None
         """
-        topic_messages: Dict[int, Dict[str, Any]] = {}
-
-        for message in messages:
-            if self._is_service_message(message):
-                # Пытаемся извлечь информацию о создании топика
-                topic_name = self._extract_topic_name_from_service_message(message)
-                created_at = self._extract_message_datetime(message)
-
-                if topic_name and created_at:
-                    message_id = self._extract_message_id(message)
-                    if message_id:
-                        topic_messages[message_id] = {
-                            'topic_name': topic_name,
-                            'created_at': created_at,
-                            'type': 'creation'
-                        }
-                        logger.debug(
-                            f"Найдено сервисное сообщение о создании топика: {topic_name} "
-                            f"(message_id: {message_id})"
-                        )
-
-                # Пытаемся извлечь информацию о переименовании топика
-                renamed_topic_name = self._extract_renamed_topic_name_from_service_message(message)
-                if renamed_topic_name and created_at:
-                    message_id = self._extract_message_id(message)
-                    if message_id:
-                        # Если уже есть запись о создании, обновляем её
-                        if message_id in topic_messages:
-                            topic_messages[message_id]['topic_name'] = renamed_topic_name
-                            topic_messages[message_id]['type'] = 'rename'
-                        else:
-                            topic_messages[message_id] = {
-                                'topic_name': renamed_topic_name,
-                                'created_at': created_at,
-                                'type': 'rename'
-                            }
-                        logger.debug(
-                            f"Найдено сервисное сообщение о переименовании топика: {renamed_topic_name} "
-                            f"(message_id: {message_id})"
-                        )
+        topic_name = self._extract_topic_name_from_service_message(message)
+        renamed_topic_name = self._extract_renamed_topic_name_from_service_message(message)
+        if not topic_name and not renamed_topic_name:
+            return None
 
-        return topic_messages
+        created_at = self._extract_message_datetime(message)
+        if created_at and message_id:
+            if renamed_topic_name:
+                topic_messages[message_id] = {
+                    'topic_name': renamed_topic_name,
+                    'created_at': created_at,
+                    'type': 'rename'
+                }
+                logger.debug(
+                    f"Найдено сервисное сообщение о переименовании топика: {renamed_topic_name} "
+                    f"(message_id: {message_id})"
+                )
+            else:
+                topic_messages[message_id] = {
+                    'topic_name': topic_name,
+                    'created_at': created_at,
+                    'type': 'creation'
+                }
+                logger.debug(
+                    f"Найдено сервисное сообщение о создании топика: {topic_name} "
+                    f"(message_id: {message_id})"
+                )
+
+        # Используем новое название если топик переименован
+        return renamed_topic_name or topic_name
 
-    def _extract_renamed_topic_name_from_service_message(self, message: Tag) -> Optional[str]:
+    @staticmethod
+    def _extract_renamed_topic_name_from_service_message(message: etree._Element) -> Optional[str]:
         """
         Извлекает новое название топика из сервисного сообщения о переименовании
         """
         try:
-            if not self._is_service_message(message):
-                return None
-
             # Ищем текст сообщения
-            body = message.find('div', class_='body')
-            if body:
-                text = body.get_text(strip=True)
+            body = _find_div(message, 'body')
+            if body is not None:
+                text = _text(body)
                 # Ищем паттерн переименования топика
-                pattern_str = r'changed topic title to\s+«([^»]+)»'
-                match = re.search(pattern_str, text, re.IGNORECASE)
+                match = _TOPIC_RENAMED_RE.search(text)
                 if match:
                     return match.group(1)
 
-                # Альтернативные паттерны для переименования
-                patterns = [
-                    r'изменил\(а\)\s+название\s+топика\s+на\s+«([^»]+)»',
-                    r'переименовал\(а\)\s+топик\s+в\s+«([^»]+)»',
-                    r'topic title changed to\s+«([^»]+)»',
-                    r'название\s+топика\s+изменено\s+на\s+«([^»]+)»'
-                ]
-
-                for pattern in patterns:
-                    match = re.search(pattern, text, re.IGNORECASE)
-                    if match:
-                        return match.group(1)
-
         except Exception as e:
             logger.error(f"Ошибка извлечения нового названия топика из сервисного сообщения: {e}")
 
         return None
 
-    def _extract_topic_id(self, message: Tag, topic_creation_messages: Dict[int, Dict[str, Any]]) -> Optional[int]:
+    def _extract_topic_id(self, message: etree._Element, parent_message_id: Optional[int],
+                          topic_creation_messages: Dict[int, Dict[str, Any]],
+                          topic_index: Dict[str, int], service_topic_name: Optional[str] = None) -> Optional[int]:
         """
         Извлекает ID топика из сообщения, учитывая сервисные сообщения о создании и переименовании топиков
+
+        parent_message_id - ID сообщения, на которое отвечает это сообщение
+        topic_index - топики-источники: {название в нижнем регистре: topic_id}
+        service_topic_name - название топика, если это сервисное сообщение о его создании или переименовании
         """
         try:
-            # Если это сервисное сообщение о создании или переименовании топика - ищем topic_id по имени в БД
-            if self._is_service_message(message):
-                topic_name = self._extract_topic_name_from_service_message(message)
-                renamed_topic_name = self._extract_renamed_topic_name_from_service_message(message)
-
-                # Используем новое название если топик переименован
-                target_topic_name = renamed_topic_name if renamed_topic_name else topic_name
-
-                if target_topic_name:
-                    # Ищем topic_id в БД по имени топика
-                    source_topics = self.db.get_source_topics()
-                    for topic in source_topics:
-                        if topic['topic_name'] and target_topic_name.lower() in topic['topic_name'].lower():
-                            logger.debug(f"Найден topic_id {topic['topic_id']} для топика '{target_topic_name}'")
-                            return topic['topic_id']
+            # Если это сервисное сообщение о создании или переименовании топика - ищем topic_id по имени
+            if service_topic_name:
+                topic_id = self._find_topic_by_name(service_topic_name, topic_index)
+                if topic_id:
+                    logger.debug(f"Найден topic_id {topic_id} для топика '{service_topic_name}'")
+                    return topic_id
 
             # Для обычных сообщений проверяем, не является ли это ответом на сервисное сообщение
-            parent_message_id = self._extract_parent_message_id(message)
             if parent_message_id and parent_message_id in topic_creation_messages:
                 topic_name = topic_creation_messages[parent_message_id]['topic_name']
-                # Ищем topic_id в БД по имени топика
-                source_topics = self.db.get_source_topics()
-                for topic in source_topics:
-                    if topic['topic_name'] and topic_name.lower() in topic['topic_name'].lower():
-                        logger.debug(f"Найден topic_id {topic['topic_id']} для топика '{topic_name}' (через реплай)")
-                        return topic['topic_id']
+                # Ищем topic_id по имени топика
+                topic_id = self._find_topic_by_name(topic_name, topic_index)
+                if topic_id:
+                    logger.debug(f"Найден topic_id {topic_id} для топика '{topic_name}' (через реплай)")
+                    return topic_id
 
             # Стандартные методы поиска topic_id
-            topic_links = message.find_all('a', href=True)
-            for link in topic_links:
-                href = link.get('href', '')
-                topic_match = re.search(r'topic[_-]?(\d+)', href, re.IGNORECASE)
+            for link in message.iterdescendants('a'):
+                href = link.get('href')
+                if href is None:
+                    continue
+                topic_match = _TOPIC_HREF_RE.search(href)
                 if topic_match:
                     return int(topic_match.group(1))
 
-            # Ищем в тексте сообщения упоминания топиков
-            text_elements = message.find_all(text=True)
-            for text in text_elements:
-                topic_match = re.search(r'топик[_\s]*(\d+)', text, re.IGNORECASE)
+            # Ищем в тексте сообщения упоминания топиков: текст собирается один раз,
+            # регулярка запускается только если слово «топик» вообще встречается
+            text = ' '.join(message.itertext())
+            if 'топик' in text.lower():
+                topic_match = _TOPIC_TEXT_RE.search(text)
                 if topic_match:
                     return int(topic_match.group(1))
 
@@ -229,35 +321,36 @@ class HTMLParserService:
             logger.error(f"Ошибка извлечения topic_id: {e}")
             return None
 
-    def _extract_topic_name_from_service_message(self, message: Tag) -> Optional[str]:
+    @staticmethod
+    def _find_topic_by_name(topic_name: str, topic_index: Dict[str, int]) -> Optional[int]:
+        """
+        Ищет topic_id топика-источника, в название которого входит topic_name (без учета регистра)
+
+        Сначала проверяется точное совпадение названия, перебор по подстроке - только при промахе
+        """
+        needle = topic_name.lower()
+        topic_id = topic_index.get(needle)
+        if topic_id is not None:
+            return topic_id
+        for name, topic_id in topic_index.items():
+            if needle in name:
+                return topic_id
+        return None
+
+    @staticmethod
+    def _extract_topic_name_from_service_message(message: etree._Element) -> Optional[str]:
         """
         Извлекает название топика из сервисного сообщения
         """
         try:
-            if not self._is_service_message(message):
-                return None
-
             # Ищем текст сообщения
-            body = message.find('div', class_='body')
-            if body:
-                text = body.get_text(strip=True)
+            body = _find_div(message, 'body')
+            if body is not None:
+                text = _text(body)
                 # Ищем паттерн создания топика
-                pattern_str = r'created topic\s+«([^»]+)»'
-                match = re.search(pattern_str, text, re.IGNORECASE)
+                match = _TOPIC_CREATED_RE.search(text)
                 if match:
-                    return match.group(1)
-
-                # Альтернативные паттерны
-                patterns = [
-                    r'создал\(а\)\s+топик\s+«([^»]+)»',
-                    r'topic\s+«([^»]+)»\s+created',
-                    r'топик\s+«([^»]+)»\s+создан'
-                ]
-
-                for pattern in patterns:
-                    match = re.search(pattern, text, re.IGNORECASE)
-                    if match:
-                        return match.group(1)
+                    return match.group(1) or match.group(2)
 
         except Exception as e:
             logger.error(f"Ошибка извлечения названия топика из сервисного сообщения: {e}")
@@ -265,63 +358,38 @@ class HTMLParserService:
         return None
 
     @staticmethod
-    def _is_service_message(message: Tag) -> bool:
+    def _is_service_message(message: etree._Element) -> bool:
         """
         Проверяет, является ли сообщение сервисным
         """
-        try:
-            classes = message.get('class', [])
-            if isinstance(classes, list):
-                return 'message' in classes and 'service' in classes
-            return False
-        except Exception as e:
-            logger.error(f"Ошибка проверки сервисного сообщения: {e}")
-            return False
+        classes = _classes(message)
+        return 'message' in classes and 'service' in classes
 
     @staticmethod
-    def _extract_message_datetime(message: Tag) -> Optional[datetime]:
+    def _extract_message_datetime(message: etree._Element) -> Optional[datetime]:
         """
         Извлекает дату и время из сообщения
         """
         try:
             # Ищем время в сообщении
-            time_element = message.find('div', class_='date')
-            if time_element:
+            time_element = _find_div(message, 'date')
+            if time_element is not None:
                 time_text = time_element.get('title', '')
                 if time_text:
-                    result_date = datetime.strptime(time_text, "%d.%m.%Y %H:%M:%S UTC+03:00")
-                    return result_date
+                    return _parse_export_datetime(time_text)
 
         except Exception as e:
             logger.error(f"Ошибка извлечения времени сообщения: {e}")
             return None
 
-    @staticmethod
-    def _extract_message_id(message: Tag) -> int:
+    def _parse_message(self, message: etree._Element, message_id: int, parent_message_id: Optional[int],
+                       topic_id: Optional[int], service_message_ids: Set[int]) -> Optional[Dict[str, Any]]:
         """
-        Извлекает ID сообщения
-        """
-        try:
-            message_id = message.get('id')
-            if message_id:
-                id_match = re.search(r'message-?(\d+)', message_id, re.IGNORECASE)
-                if id_match:
-                    return int(id_match.group(1))
+        Парсит отдельное (не сервисное) сообщение
 
-        except Exception as e:
-            logger.error(f"Ошибка извлечения message_id: {e}")
-            return 0
-
-    def _parse_message(self, message: Tag, topic_id: Optional[int]) -> Optional[Dict[str, Any]]:
-        """
-        Парсит отдельное сообщение
+        service_message_ids - ID сервисных сообщений, встреченных в файле до этого сообщения
         """
         try:
-            # Пропускаем сервисные сообщения
-            if self._is_service_message(message):
-                return None
-
-            message_id = self._extract_message_id(message)
             if not message_id:
                 return None
 
@@ -347,10 +415,9 @@ class HTMLParserService:
 
             message_data['message_text'] = message_text
 
-            # Извлекаем информацию о родительском сообщении (реплай)
-            parent_message_id = self._extract_parent_message_id(message)
+            # Информация о родительском сообщении (реплай)
             if parent_message_id:
-                if not self._is_parent_service_message(parent_message_id, message):
+                if not self._is_parent_service_message(parent_message_id, service_message_ids):
                     message_data['parent_message_id'] = parent_message_id
 
             return message_data
@@ -359,37 +426,24 @@ class HTMLParserService:
             logger.error(f"Ошибка парсинга сообщения: {e}")
             return None
 
-    def _is_parent_service_message(self, parent_message_id: int, current_message: Tag) -> bool:
+    @staticmethod
+    def _is_parent_service_message(parent_message_id: int, service_message_ids: Set[int]) -> bool:
         """
         Проверяет, является ли родительское сообщение сервисным
-        """
-        try:
-            parent_selector = f'div[id="message-{parent_message_id}"], div[id="message{parent_message_id}"]'
-            parent_message = current_message.find_previous_sibling(parent_selector)
-
-            if not parent_message:
-                soup = current_message.find_parent()
-                if soup:
-                    parent_message = soup.find('div', id=re.compile(f'^message-?{parent_message_id}$'))
-
-            if parent_message:
-                return self._is_service_message(parent_message)
 
-            return False
-
-        except Exception as e:
-            logger.error(f"Ошибка проверки сервисного родителя: {e}")
-            return False
+        Родитель в экспорте идет раньше реплая, поэтому уже есть среди встреченных сервисных сообщений
+        """
+        return parent_message_id in service_message_ids
 
-    def _extract_message_text(self, message: Tag) -> str:
+    def _extract_message_text(self, message: etree._Element) -> str:
         """
         Извлекает текст сообщения
         """
         try:
             # Для обычных сообщений ищем блок с текстом
-            text_body = message.find('div', class_='text')
-            if text_body:
-                text = text_body.get_text(strip=True)
+            text_body = _find_div(message, 'text')
+            if text_body is not None:
+                text = _text(text_body)
                 if text:
                     return self._clean_text(text)
 
@@ -400,22 +454,15 @@ class HTMLParserService:
             return ''
 
     @staticmethod
-    def _extract_parent_message_id(message: Tag) -> Optional[int]:
+    def _extract_parent_message_id(message: etree._Element) -> Optional[int]:
         """
         Извлекает ID родительского сообщения (для реплаев)
         """
         try:
-            reply_elements = message.find_all(class_=re.compile(r'reply_to', re.IGNORECASE))
-            for element in reply_elements:
-                links = element.find_all('a', href=True)
-                for link in links:
-                    href = link.get('href', '')
-                    msg_match = re.search(r'go_to_message\((\d+)\)', href)
-                    if msg_match:
-                        return int(msg_match.group(1))
-                    msg_match = re.search(r'message[_-]?(\d+)', href, re.IGNORECASE)
-                    if msg_match:
-                        return int(msg_match.group(1))
+            for href in _REPLY_HREFS_XPATH(message):
+                msg_match = _GOTO_MESSAGE_RE.search(href) or _MESSAGE_HREF_RE.search(href)
+                if msg_match:
+                    return int(msg_match.group(1))
 
             return None
 
@@ -432,7 +479,4 @@ class HTMLParserService:
             return ''
 
         # Удаляем лишние пробелы и переносы строк
-        text = re.sub(r'\s+', ' ', text)
-        text = text.strip()
-
-        return text
+        return ' '.join(text.split())
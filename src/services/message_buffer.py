@@ -0,0 +1,63 @@
+import logging
+import asyncio
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """Отложенная запись входящих сообщений: копит их в очереди и сохраняет в БД пачками"""
+
+    def __init__(self, db, max_batch: int = 100, flush_interval: float = 0.2):
+        self.db = db
+        self.max_batch = max_batch  # Максимум сообщений в одной транзакции
+        self.flush_interval = flush_interval  # Сколько секунд ждем добора пачки
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._rows: List[Dict] = []  # Сообщения, которые run уже забрал из очереди и копит в пачку
+        self._writing: Optional[asyncio.Task] = None  # Запись последней пачки; отмена run ее не прерывает
+
+    def add(self, message_data: Dict):
+        """Ставит сообщение в очередь на запись (не блокирует event loop)"""
+        self._queue.put_nowait(message_data)
+
+    async def run(self):
+        """Фоновая задача: пишет сообщения пачками по max_batch или раз в flush_interval"""
+        try:
+            while True:
+                self._rows.append(await self._queue.get())
+                # Даем пачке набраться, если она еще не полная
+                if self._queue.qsize() < self.max_batch - 1:
+                    await asyncio.sleep(self.flush_interval)
+                self._rows.extend(self._drain(self.max_batch - len(self._rows)))
+
+                rows, self._rows = self._rows, []
+                self._writing = asyncio.create_task(self._write(rows))
+                await asyncio.shield(self._writing)
+        except asyncio.CancelledError:
+            # При остановке дожидаемся начатой записи и дописываем то, что успели набрать
+            await self.flush()
+            raise
+
+    async def flush(self):
+        """Немедленно записывает все ожидающие сообщения: из очереди, набираемой пачки и пачки в записи"""
+        # Сначала забираем все, что ожидает записи сейчас, затем дожидаемся пачки, уже отправленной в БД
+        rows, self._rows = self._rows + self._drain(), []
+        if self._writing is not None:
+            await asyncio.shield(self._writing)
+        await self._write(rows)
+
+    def _drain(self, limit: int = None) -> List[Dict]:
+        """Забирает из очереди без ожидания не более limit сообщений (все, если limit не задан)"""
+        rows = []
+        while not self._queue.empty() and (limit is None or len(rows) < limit):
+            rows.append(self._queue.get_nowait())
+        return rows
+
+    async def _write(self, rows: List[Dict]):
+        if not rows:
+            return
+        saved = await self.db.run(self.db.save_messages, rows)
+        if saved == len(rows):
+            logger.debug(f"Сохранено сообщений пачкой: {saved}")
+        else:
+            logger.error(f"Ошибка пакетного сохранения: сохранено {saved} из {len(rows)} сообщений")
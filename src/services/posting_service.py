@@ -1,31 +1,74 @@
+import re
+import asyncio
 import logging
-from typing import List, Dict
+from collections import defaultdict
+from typing import List, Dict, Optional
 from datetime import datetime, timedelta
+from string import Formatter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
 logger = logging.getLogger(__name__)
 
+# Раздел с целями в тексте анонса и строки целей в нем
+_GOALS_SECTION_RE = re.compile(r'🎯 Предлагаемые Цели.*?(?=\n\n|$)', re.DOTALL)
+_GOAL_BRACKET_RE = re.compile(r'\d+\.\s*<b>\[([^\]]+)\]</b>')
+_GOAL_PLAIN_RE = re.compile(r'\d+\.\s*<b>([^<]+)</b>')
+
+# Кнопки под черновиком поста: (текст, префикс callback_data)
+_POST_BUTTONS = (("✅ Опубликовать", "publish_post"), ("❌ Редактировать", "edit_post"))
+
+
+def _trunc(s: str, n: int, ell: str = '...') -> str:
+    """Обрезает строку до n символов, добавляя ell, если она длиннее"""
+    return s if len(s) <= n else s[:n] + ell
+
+
+def _static_template_head(template: str) -> str:
+    """Текст шаблона str.format до первой подстановки (экранированные {{ }} уже раскрыты)"""
+    head = ""
+    for literal, field_name, _, _ in Formatter().parse(template):
+        head += literal
+        if field_name is not None:
+            break
+    return head
+
+
+def _make_post_markup(message_obj_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура «Опубликовать / Редактировать» для черновика поста с указанным ID"""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=text, callback_data=f"{action}:{message_obj_id}")
+        for text, action in _POST_BUTTONS
+    ]])
+
 
 class PostingService:
-    def __init__(self, db, ai_client, main_chat_id, admin_chat_id):
+    MAX_CONCURRENT_LLM_REQUESTS = 2  # Сколько постов одновременно генерируется через LLM
+
+    def __init__(self, db, ai_client, main_chat_id, admin_chat_id, send_queue=None):
         self.db = db
         self.ai_client = ai_client
         self.main_chat_id = main_chat_id
         self.admin_chat_id = admin_chat_id
+        self.send_queue = send_queue  # Очередь отправки с лимитами Telegram (SendQueue); без нее шлем напрямую
+        self._llm_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_LLM_REQUESTS)
 
-    async def create_monday_post(self, bot):
-        """Создает пост с целями/блокерами на неделю (Пн 10:00)"""
+    async def create_monday_post(self, bot, use_cache: bool = True):
+        """Создает пост с целями/блокерами на неделю (Пн 10:00)
+
+        use_cache - при повторном запуске на тех же данных взять ответ LLM из кэша
+        """
         try:
-            announce_topic = self.db.get_system_topic("announce")
+            announce_topic = await self.db.run(self.db.get_system_topic, "announce")
             if not announce_topic:
                 logger.error("Топик announce не настроен")
                 return False
 
             # Получаем активные треды за последнюю неделю ТОЛЬКО с классификацией 'goal' или 'blocker'
             # Это гарантирует, что пост формируется на основе уже выделенных AI целей и блеров
-            active_threads = self.db.get_active_threads_with_messages(days=7)
-            relevant_threads = [t for t in active_threads if t['classification_id'] in ['goal', 'blocker']]
+            relevant_threads = await self.db.run(
+                self.db.get_active_threads_with_messages, days=7, classifications=('goal', 'blocker')
+            )
 
             if not relevant_threads:
                 logger.info("Нет активных тредов 'goal' или 'blocker' для понедельничного поста")
@@ -36,19 +79,24 @@ class PostingService:
             logger.info(f"Найдено {len(relevant_threads)} релевантных тредов для поста.")
 
             # Используем промпт для анонсов
-            prompt = self.db.get_prompt("announce")
+            prompt = await self.db.run(self.db.get_prompt, "announce")
             if not prompt:
                 logger.error("Промпт для анонсов не настроен")
                 return False
 
             # Подготовка контекста ТОЛЬКО из релевантных тредов
             message_context = self._prepare_monday_context(relevant_threads)
-            full_prompt = f"{prompt}\n\nКонтекст для анализа:\n{message_context}"
 
-            post_text = await self.ai_client.send_request_with_retry(full_prompt)
+            # Промпт из БД неизменен между запусками - отправляем его кэшируемым префиксом
+            async with self._llm_semaphore:
+                post_text = await self.ai_client.send_request_with_retry(
+                    f"Контекст для анализа:\n{message_context}",
+                    cached_prefix=f"{prompt}\n\n",
+                    use_cache=use_cache
+                )
 
             # Сначала сохраняем сообщение в БД
-            message_obj_id = self.db.save_message({
+            message_obj_id = await self.db.run(self.db.save_message, {
                 'message_id': None,
                 'topic_id': announce_topic['topic_id'],
                 'message_text': post_text,
@@ -58,12 +106,9 @@ class PostingService:
                 'processed': True
             })
 
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"publish_post:{message_obj_id}"),
-                 InlineKeyboardButton(text="❌ Редактировать", callback_data=f"edit_post:{message_obj_id}")]
-            ])
+            markup = _make_post_markup(message_obj_id)
 
-            await bot.send_message(chat_id=self.admin_chat_id, text=post_text, reply_markup=markup)
+            await self._send_to_admin(bot, post_text, markup)
             logger.info("Понедельничный пост опубликован")
             return True
 
@@ -71,59 +116,71 @@ class PostingService:
             logger.error(f"Error creating Monday post: {e}")
             return False
 
+    async def _send_to_admin(self, bot, text: str, markup: InlineKeyboardMarkup):
+        """Отправляет черновик поста в админский чат (через очередь с лимитами, если она есть)"""
+        if self.send_queue is not None:
+            await self.send_queue.send_message(chat_id=self.admin_chat_id, text=text, reply_markup=markup)
+        else:
+            await bot.send_message(chat_id=self.admin_chat_id, text=text, reply_markup=markup)
+
     def _prepare_monday_context(self, relevant_threads: List[Dict]) -> str:
         """Подготавливает контекст из релевантных (goal/blocker) тредов для понедельничного поста."""
-        context_parts = []
-        for thread in relevant_threads:
-            # Формируем строку с информацией о треде
-            thread_info = f"- Тред '{thread['title']}' (Классификация: {thread['classification_id']})"
-            # Добавляем ключевые сообщения из треда, если они есть
-            if thread['messages']:
-                # Берем, например, последние 2-3 сообщения для контекста
-                # Можно также использовать первое сообщение треда как основное описание
-                key_messages = thread['messages'][-3:]  # Берем последние 3 сообщения
-                thread_info += f". Ключевые моменты: {'; '.join(key_messages[:2])}"  # Ограничиваем длину
-            context_parts.append(thread_info)
-        # Объединяем все в одну строку
-        return "\n".join(context_parts)
-
-    async def create_friday_digest(self, bot):
-        """Создает еженедельный дайджест (Пт 19:00)"""
+        # Строка на тред собирается одним f-string и сразу уходит в join, без промежуточного списка
+        return "\n".join(
+            f"- Тред '{thread['title']}' (Классификация: {thread['classification_id']})"
+            # Ключевые моменты: из последних 3 сообщений треда берем первые 2 (ограничиваем длину)
+            + (f". Ключевые моменты: {'; '.join(thread['messages'][-3:][:2])}" if thread['messages'] else "")
+            for thread in relevant_threads
+        )
+
+    async def create_friday_digest(self, bot, use_cache: bool = True):
+        """Создает еженедельный дайджест (Пт 19:00)
+
+        use_cache - при повторном запуске на тех же данных взять ответ LLM из кэша
+        """
         try:
-            digest_topic = self.db.get_system_topic("digest")
+            # Сначала то, без чего дайджест не строится: топик дайджеста и сообщения за неделю.
+            # В тихую неделю выходим сразу, не запрашивая треды, анонс и промпт
+            digest_topic, recent_messages = await asyncio.gather(
+                self.db.run(self.db.get_system_topic, "digest"),
+                self.db.run(self.db.get_messages_for_period, days=7),
+            )
+
             if not digest_topic:
                 logger.error("Топик Анонсы не настроен")
                 return False
 
-            # Получаем сообщения из БД за последнюю неделю
-            recent_messages = self.db.get_messages_for_period(days=7)
             if not recent_messages:
                 logger.info("Нет сообщений в БД для Friday Digest")
                 return False
 
-            # Получаем активные треды за неделю для "Разбиения по топикам"
-            active_threads = self.db.get_active_threads_with_messages(days=7)
+            # Остальные запросы независимы - выполняем их параллельно в потоках, а не по очереди:
+            # активные треды (для "Разбиения по топикам"), цели и блокеры за неделю,
+            # последний анонс целей, промпт для дайджестов
+            active_threads, weekly_threads, last_announcement, prompt = await asyncio.gather(
+                self.db.run(self.db.get_active_threads_with_messages, days=7),
+                self.db.run(self.db.get_threads_by_classifications, ['goal', 'blocker'], days=7),
+                self.db.run(self.db.get_last_announcement),
+                self.db.run(self.db.get_prompt, "digest"),
+            )
 
-            # Получаем топики-источники
-            source_topics = self.db.get_source_topics()
+            if not prompt:
+                logger.error("Промпт для дайджестов не настроен")
+                return False
 
-            # Получаем цели и блокеры за неделю
-            weekly_goals = self.db.get_threads_by_classification('goal', days=7)
-            weekly_blockers = self.db.get_threads_by_classification('blocker', days=7)
+            # Цели и блокеры недели приходят одним запросом - раскладываем по классификации
+            threads_by_classification: Dict[str, List[Dict]] = defaultdict(list)
+            for thread in weekly_threads:
+                threads_by_classification[thread['classification_id']].append(thread)
+            weekly_goals = threads_by_classification['goal']
+            weekly_blockers = threads_by_classification['blocker']
 
-            # Получаем последний анонс целей и извлекаем из него цели
-            last_announcement = self.db.get_last_announcement()
+            # Извлекаем цели из последнего анонса
             last_goals_from_announcement = self._extract_goals_from_announcement(
                 last_announcement) if last_announcement else []
 
-            # Используем промпт для дайджестов
-            prompt = self.db.get_prompt("digest")
-            if not prompt:
-                logger.error("Промпт для дайджестов не настроен")
-                return False
-
             # Подготовка контекста для каждого раздела
-            topics_context = self._prepare_digest_topics_context(active_threads, source_topics)
+            topics_context = self._prepare_digest_topics_context(active_threads)
             goals_progress_context = self._prepare_goals_progress_context(last_goals_from_announcement, recent_messages)
             blockers_context = self._prepare_digest_blockers_context(weekly_blockers)
             new_goals_context = self._prepare_digest_new_goals_context(weekly_goals)
@@ -150,16 +207,27 @@ class PostingService:
             end_date = datetime.now()
             start_date = end_date - timedelta(days=7)
 
-            full_prompt = prompt.format(
-                message_context=message_context,
-                start_date=start_date.strftime('%d.%m.%Y'),
-                end_date=end_date.strftime('%d.%m.%Y')
-            )
-
-            post_text = await self.ai_client.send_request_with_retry(full_prompt)  # Используем retry
+            dates = {
+                'start_date': start_date.strftime('%d.%m.%Y'),
+                'end_date': end_date.strftime('%d.%m.%Y')
+            }
+
+            # Кэшируемым префиксом отправляем текст шаблона до первой подстановки (контекста или дат) -
+            # он одинаков от недели к неделе; остальное, уже с подставленными значениями, идет следом
+            full_prompt = prompt.format(message_context=message_context, **dates)
+            static_head = _static_template_head(prompt)
+            if static_head and static_head != full_prompt:
+                cached_prefix, dynamic_prompt = static_head, full_prompt[len(static_head):]
+            else:
+                cached_prefix, dynamic_prompt = None, full_prompt
+
+            async with self._llm_semaphore:
+                post_text = await self.ai_client.send_request_with_retry(  # Используем retry
+                    dynamic_prompt, cached_prefix=cached_prefix, use_cache=use_cache
+                )
 
             # Сначала сохраняем сообщение в БД
-            message_obj_id = self.db.save_message({
+            message_obj_id = await self.db.run(self.db.save_message, {
                 'message_id': None,
                 'topic_id': digest_topic['topic_id'],
                 'message_text': post_text,
@@ -169,12 +237,9 @@ class PostingService:
                 'processed': True
             })
 
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"publish_post:{message_obj_id}"),
-                 InlineKeyboardButton(text="❌ Редактировать", callback_data=f"edit_post:{message_obj_id}")]
-            ])
+            markup = _make_post_markup(message_obj_id)
 
-            await bot.send_message(chat_id=self.admin_chat_id, text=post_text, reply_markup=markup)
+            await self._send_to_admin(bot, post_text, markup)
             logger.info("Пятничный дайджест создан с новой структурой")
             return True
 
@@ -182,28 +247,37 @@ class PostingService:
             logger.error(f"Error creating Friday digest: {e}")
             return False
 
-    def _prepare_digest_topics_context(self, active_threads: List[Dict], source_topics: List[Dict]) -> str:
-        """Подготавливает ЧИСТЫЙ контекст для раздела топиков"""
+    def _prepare_digest_topics_context(self, active_threads: List[Dict]) -> str:
+        """Подготавливает ЧИСТЫЙ контекст для раздела топиков
+
+        Название топика приходит вместе с тредом из БД (topic_name; None - топик не источник)
+        """
         if not active_threads:
             return "Нет активных обсуждений"
 
-        topic_names = {t['topic_id']: t['topic_name'] for t in source_topics}
-        context_parts = []
-
+        # Группируем треды по топику, чтобы выводить их в порядке топиков-источников
+        threads_by_topic: Dict[Optional[int], List[Dict]] = defaultdict(list)
         for thread in active_threads:
-            topic_id = thread.get('topic_id')
-            topic_name = topic_names.get(topic_id, "Общие обсуждения")
-            thread_title = thread.get('title', 'Без названия')
+            threads_by_topic[thread.get('topic_id')].append(thread)
 
-            # Берем только релевантные сообщения (не пустые)
-            relevant_messages = [msg for msg in thread.get('messages', [])
-                                 if msg and msg != "Тред без сообщений...."]
+        # Сначала топики-источники по topic_id, затем треды вне них
+        topic_groups = sorted(
+            ((threads[0].get('topic_name'), topic_id, threads) for topic_id, threads in threads_by_topic.items()),
+            key=lambda group: (group[0] is None, group[1] or 0)
+        )
 
-            if relevant_messages:
-                # Берем последнее значимое сообщение как контекст
-                last_message = relevant_messages[-1][:150] + "..." if len(relevant_messages[-1]) > 150 else \
-                relevant_messages[-1]
-                context_parts.append(f"{topic_name} | {thread_title}: {last_message}")
+        context_parts = []
+        for topic_name, _, threads in topic_groups:
+            topic_name = topic_name or "Общие обсуждения"
+            for thread in threads:
+                # Берем последнее значимое (не пустое) сообщение как контекст, не копируя список сообщений
+                last_message = next((msg for msg in reversed(thread.get('messages', []))
+                                     if msg and msg != "Тред без сообщений...."), None)
+                if last_message is None:
+                    continue
+
+                thread_title = thread.get('title', 'Без названия')
+                context_parts.append(f"{topic_name} | {thread_title}: {_trunc(last_message, 150)}")
 
         return "\n".join(context_parts) if context_parts else "Нет значимых обсуждений"
 
@@ -212,66 +286,75 @@ class PostingService:
         if not last_goals:
             return "Нет целей из предыдущего анонса"
 
+        # Все сообщения недели приводим к нижнему регистру один раз, а не для каждой цели
+        haystack = "\n".join(msg.get('message_text') or '' for msg in recent_messages).lower()
+
         context_parts = []
-        for goal in last_goals:
+        for goal, goal_lower in zip(last_goals, [goal.lower() for goal in last_goals]):
             # Простая проверка упоминания
-            mentioned = any(goal.lower() in msg.get('message_text', '').lower()
-                            for msg in recent_messages)
+            mentioned = goal_lower in haystack
             status = "обсуждалась" if mentioned else "не упоминалась"
             context_parts.append(f"{goal} - {status}")
 
         return "\n".join(context_parts)
 
+    @staticmethod
+    def _format_threads_descriptions(threads: List[Dict]) -> str:
+        """Строки «название: начало первого сообщения» для тредов"""
+        return "\n".join(
+            f"{thread.get('title', 'Без названия')}: "
+            f"{_trunc(thread['messages'][0], 100) if thread.get('messages') else 'Описание отсутствует'}"
+            for thread in threads
+        )
+
     def _prepare_digest_blockers_context(self, weekly_blockers: List[Dict]) -> str:
         """Чистый контекст для блокеров"""
         if not weekly_blockers:
             return "Нет новых блокеров"
-
-        context_parts = []
-        for blocker in weekly_blockers:
-            title = blocker.get('title', 'Без названия')
-            messages = blocker.get('messages', [])
-            description = messages[0][:100] + "..." if messages else "Описание отсутствует"
-            context_parts.append(f"{title}: {description}")
-
-        return "\n".join(context_parts)
+        return self._format_threads_descriptions(weekly_blockers)
 
     def _prepare_digest_new_goals_context(self, weekly_goals: List[Dict]) -> str:
         """Чистый контекст для новых целей"""
         if not weekly_goals:
             return "Нет новых целей"
-
-        context_parts = []
-        for goal in weekly_goals:
-            title = goal.get('title', 'Без названия')
-            messages = goal.get('messages', [])
-            description = messages[0][:100] + "..." if messages else "Описание отсутствует"
-            context_parts.append(f"{title}: {description}")
-
-        return "\n".join(context_parts)
+        return self._format_threads_descriptions(weekly_goals)
 
     def _extract_goals_from_announcement(self, announcement_text: str) -> List[str]:
         """Извлекает цели из текста последнего анонса (простой парсинг)."""
         # Простой способ: найти строки, начинающиеся с 1., 2., 3. в разделе "🎯 Предлагаемые Цели"
-        import re
         # Ищем раздел с целями
-        goals_section_match = re.search(r'🎯 Предлагаемые Цели.*?(?=\n\n|$)', announcement_text, re.DOTALL)
+        goals_section_match = _GOALS_SECTION_RE.search(announcement_text)
         if not goals_section_match:
             return []
         goals_section = goals_section_match.group(0)
         # Ищем цели в формате 1. <b>[Название цели]</b>
-        goal_titles = re.findall(r'\d+\.\s*<b>\[([^\]]+)\]</b>', goals_section)
+        goal_titles = _GOAL_BRACKET_RE.findall(goals_section)
         # Также ищем цели в формате 1. <b>([^<]+)</b> - если название не в квадратных скобках
-        goal_titles_alt = re.findall(r'\d+\.\s*<b>([^<]+)</b>', goals_section)
+        goal_titles_alt = _GOAL_PLAIN_RE.findall(goals_section)
         # Объединяем результаты, убирая дубликаты
-        all_titles = list(set(goal_titles + goal_titles_alt))
-        return all_titles
+        return list({*goal_titles, *goal_titles_alt})
+
+    async def create_all_posts(self, bot, use_cache: bool = True) -> bool:
+        """Создает понедельничный пост и пятничный дайджест параллельно (запросы к LLM идут одновременно)"""
+        results = await asyncio.gather(
+            self.create_monday_post(bot, use_cache=use_cache),
+            self.create_friday_digest(bot, use_cache=use_cache),
+            return_exceptions=True
+        )
+        for post_type, result in zip(("announce", "digest"), results):
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка при создании поста {post_type}: {result}")
+            elif not result:
+                logger.warning(f"Пост {post_type} не создан")
+        return all(result is True for result in results)
 
     async def create_post(self, post_type, bot):
-        """Создает тестовый пост указанного типа"""
+        """Создает тестовый пост указанного типа (всегда с новым запросом к LLM, без кэша ответов)"""
         if post_type == "announce":
-            return await self.create_monday_post(bot)
+            return await self.create_monday_post(bot, use_cache=False)
         elif post_type == "digest":
-            return await self.create_friday_digest(bot)
+            return await self.create_friday_digest(bot, use_cache=False)
+        elif post_type == "all":
+            return await self.create_all_posts(bot, use_cache=False)
         else:
             raise ValueError(f"Неизвестный тип поста: {post_type}")
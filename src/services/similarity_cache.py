@@ -0,0 +1,103 @@
+import math
+import re
+from collections import Counter, deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from src.utils.text import strip_filler
+
+_WORD_RE = re.compile(r'\w+')
+
+# Слова, переворачивающие смысл: тексты, различающиеся только ими, похожи лексически, но не по смыслу
+_NEGATIONS = frozenset({'не', 'нет', 'ни'})
+
+
+class LexicalSimilarityCache:
+    """Кэш классификации почти совпадающих текстов.
+
+    Текст превращается в вектор основ слов (первые stem_length символов токена),
+    поиск кандидатов идет по инвертированному индексу, сравнение - по косинусу.
+    Сравнение лексическое, поэтому отрицания и числа в текстах должны совпадать,
+    а переиспользуется только классификация - заголовок у каждого сообщения свой.
+    Записи разделены по namespace (модель и схема ответа): результат другой модели не переиспользуется.
+    Кэш живет только в памяти процесса и после перезапуска пуст
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 5000, stem_length: int = 5):
+        self.threshold = threshold  # Минимальный косинус, при котором результат переиспользуется
+        self.max_entries = max_entries
+        self.stem_length = stem_length
+        self._vectors: Dict[int, Dict[str, float]] = {}
+        self._results: Dict[int, Dict] = {}
+        # (namespace, отрицания и числа текста) - должны совпасть целиком
+        self._guards: Dict[int, Tuple[str, Tuple[str, ...]]] = {}
+        self._index: Dict[str, Set[int]] = {}
+        self._order: Deque[int] = deque()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def _vectorize(self, text: str) -> Tuple[Dict[str, float], Tuple[str, ...]]:
+        """Нормированный вектор частот основ слов и отсортированные отрицания/числа текста"""
+        tokens = _WORD_RE.findall(strip_filler(text).lower())
+        markers = tuple(sorted(token for token in tokens if token in _NEGATIONS or token.isdigit()))
+        # Однобуквенные слова (предлоги, союзы) не несут смысла, а числа - несут
+        counts = Counter(token[:self.stem_length] for token in tokens if len(token) > 1 or token.isdigit())
+        norm = math.sqrt(sum(count * count for count in counts.values()))
+        if not norm:
+            return {}, markers
+        return {stem: count / norm for stem, count in counts.items()}, markers
+
+    def lookup(self, text: str, namespace: str = '') -> Optional[Dict]:
+        """Возвращает классификацию самого похожего закэшированного текста (без заголовка) или None"""
+        vector, markers = self._vectorize(text)
+        if not vector:
+            return None
+        guard = (namespace, markers)
+
+        candidates: Set[int] = set()
+        for stem in vector:
+            candidates.update(self._index.get(stem, ()))
+
+        best: Tuple[float, int] = (0.0, -1)
+        for entry_id in candidates:
+            if self._guards[entry_id] != guard:
+                continue
+            entry_vector = self._vectors[entry_id]
+            score = sum(weight * entry_vector.get(stem, 0.0) for stem, weight in vector.items())
+            if score > best[0]:
+                best = (score, entry_id)
+
+        if best[1] >= 0 and best[0] >= self.threshold:
+            return {**self._results[best[1]], 'title': None}
+        return None
+
+    def add(self, text: str, result: Dict, namespace: str = ''):
+        """Добавляет текст и его результат классификации в кэш"""
+        vector, markers = self._vectorize(text)
+        if not vector:
+            return
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._vectors[entry_id] = vector
+        self._guards[entry_id] = (namespace, markers)
+        self._results[entry_id] = {
+            'classification': result['classification'],
+            'confidence': result['confidence']
+        }
+        for stem in vector:
+            self._index.setdefault(stem, set()).add(entry_id)
+        self._order.append(entry_id)
+
+        while len(self._order) > self.max_entries:
+            self._evict(self._order.popleft())
+
+    def _evict(self, entry_id: int):
+        for stem in self._vectors.pop(entry_id):
+            postings = self._index[stem]
+            postings.discard(entry_id)
+            if not postings:
+                del self._index[stem]
+        del self._results[entry_id]
+        del self._guards[entry_id]
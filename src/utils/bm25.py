@@ -0,0 +1,48 @@
+import math
+import re
+from collections import Counter
+from typing import List
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def stem_tokens(text: str, stem_length: int = 5) -> List[str]:
+    """Токены текста, усеченные до основы из stem_length символов"""
+    return [token[:stem_length] for token in _WORD_RE.findall(text.lower()) if len(token) > 1 or token.isdigit()]
+
+
+class BM25Index:
+    """Индекс BM25 (Okapi) по небольшому набору документов"""
+
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._doc_counts = [Counter(stem_tokens(document)) for document in documents]
+        self._doc_lengths = [sum(counts.values()) for counts in self._doc_counts]
+        self._avg_length = (sum(self._doc_lengths) / len(self._doc_lengths)) if self._doc_lengths else 0.0
+
+        document_frequency = Counter()
+        for counts in self._doc_counts:
+            document_frequency.update(counts.keys())
+        total = len(self._doc_counts)
+        self._idf = {term: math.log((total - freq + 0.5) / (freq + 0.5) + 1) for term, freq in document_frequency.items()}
+
+    def scores(self, query: str) -> List[float]:
+        """Оценка релевантности каждого документа запросу"""
+        terms = [term for term in set(stem_tokens(query)) if term in self._idf]
+        result = []
+        for counts, length in zip(self._doc_counts, self._doc_lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length) if self._avg_length else self.k1
+            for term in terms:
+                freq = counts.get(term)
+                if freq:
+                    score += self._idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            result.append(score)
+        return result
+
+    def top(self, query: str, k: int) -> List[int]:
+        """Индексы k самых релевантных документов (только с ненулевой оценкой)"""
+        scores = self.scores(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: scores[i], reverse=True)
+        return ranked[:k]
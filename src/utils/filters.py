@@ -1,21 +1,38 @@
+import time
 from aiogram.filters import Filter
 from aiogram.types import Message
 
 
 class SourceTopicsFilter(Filter):
-    def __init__(self, db, main_chat_id: str):
+    def __init__(self, db, main_chat_id: str, refresh_interval: float = 60.0):
         self.db = db
-        self.main_chat_id = main_chat_id
+        # ID чата приводим к int один раз, чтобы не форматировать строку на каждом сообщении
+        self.main_chat_id = int(main_chat_id) if main_chat_id else None
+        self.refresh_interval = refresh_interval  # Как часто перечитывать топики-источники из БД (сек)
+        self._source_topic_ids: frozenset = frozenset()
+        self._refresh_at = 0.0
+        self._refresh_source_topics()
+
+    def _refresh_source_topics(self, source_topics=None):
+        """Обновляет множество ID топиков-источников (перечитывает из БД, если список не передан)"""
+        if source_topics is None:
+            source_topics = self.db.get_source_topics()
+        self._source_topic_ids = frozenset(topic['topic_id'] for topic in source_topics)
+        self._refresh_at = time.monotonic() + self.refresh_interval
+
+    def invalidate(self):
+        """Сбрасывает кэш: топики-источники перечитаются из БД на следующем сообщении"""
+        self._refresh_at = 0.0
 
     async def __call__(self, message: Message) -> bool:
         # Проверяем, что сообщение из основного чата
-        if str(message.chat.id) != self.main_chat_id:
+        if message.chat.id != self.main_chat_id:
             return False
 
-        # Получаем список топиков-источников
-        source_topics = self.db.get_source_topics()
-        source_topic_ids = [topic['topic_id'] for topic in source_topics]
+        # Обновляем закэшированный список топиков-источников не чаще раза в refresh_interval
+        if time.monotonic() >= self._refresh_at:
+            self._refresh_source_topics(await self.db.run(self.db.get_source_topics))
 
         # Проверяем, что сообщение из нужного топика
-        return (hasattr(message, 'message_thread_id') and
-                message.message_thread_id in source_topic_ids)
+        thread_id = getattr(message, 'message_thread_id', None)
+        return thread_id is not None and thread_id in self._source_topic_ids
@@ -0,0 +1,67 @@
+import json
+from typing import Dict, List
+
+
+class JsonArrayStreamParser:
+    """Инкрементальный разбор массива объектов из потокового JSON-ответа.
+
+    Ответ подается кусками через feed(); как только очередной объект массива
+    array_key закрывается, он возвращается, не дожидаясь конца ответа
+    """
+
+    def __init__(self, array_key: str = 'results'):
+        self.array_key = array_key
+        self.items_seen = 0
+        self._decoder = json.JSONDecoder()
+        self._chunks: List[str] = []
+        self._buffer = ""
+        self._pos = None  # Позиция внутри массива; None - начало массива еще не найдено
+        self._finished = False
+
+    @property
+    def text(self) -> str:
+        """Весь полученный на данный момент текст ответа"""
+        return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Добавляет кусок ответа и возвращает объекты массива, завершенные в нем"""
+        self._chunks.append(chunk)
+        if self._finished:
+            return []
+        self._buffer += chunk
+
+        if self._pos is None:
+            key_pos = self._buffer.find(f'"{self.array_key}"')
+            if key_pos < 0:
+                return []
+            array_pos = self._buffer.find('[', key_pos)
+            if array_pos < 0:
+                return []
+            self._pos = array_pos + 1
+
+        items = []
+        buffer = self._buffer
+        while True:
+            # Пропускаем пробелы и запятые между элементами
+            pos = self._pos
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            self._pos = pos
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                self._finished = True
+                break
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Объект еще не пришел целиком
+            self._pos = end
+            if isinstance(item, dict):
+                items.append(item)
+
+        # Отбрасываем уже разобранную часть буфера
+        self._buffer = buffer[self._pos:]
+        self._pos = 0
+        self.items_seen += len(items)
+        return items
@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Асинхронный ограничитель частоты запросов: не больше rate запросов за period секунд.
+
+    Используется как `async with limiter:` вокруг вызова AI; пока токены есть, ожидания нет
+    """
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate / self.period)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Забирает один токен, при необходимости дожидаясь его появления"""
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
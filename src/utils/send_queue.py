@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Dict
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from src.utils.rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue:
+    """Очередь исходящих сообщений бота с учетом лимитов Telegram.
+
+    Отправка идет из одной фоновой задачи: не больше global_rate сообщений в секунду на бота
+    и per_chat_rate в секунду на чат; при TelegramRetryAfter ждем указанное время и повторяем
+    """
+
+    def __init__(self, bot, global_rate: float = 30, per_chat_rate: float = 1, max_retries: int = 3):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries  # Сколько раз повторяем отправку после TelegramRetryAfter
+        self._global_limiter = TokenBucket(global_rate, 1.0)
+        self._chat_limiters: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    async def send_message(self, **kwargs):
+        """Ставит сообщение в очередь и ждет его отправки; возвращает результат bot.send_message"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((kwargs, future))
+        return await future
+
+    async def run(self):
+        """Фоновая задача: отправляет сообщения из очереди по одному с соблюдением лимитов"""
+        while True:
+            kwargs, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                future.set_result(await self._send(kwargs))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+
+    async def _send(self, kwargs: Dict):
+        chat_limiter = self._chat_limiters.get(kwargs['chat_id'])
+        if chat_limiter is None:
+            chat_limiter = self._chat_limiters[kwargs['chat_id']] = TokenBucket(self.per_chat_rate, 1.0)
+
+        for attempt in range(self.max_retries + 1):
+            await self._global_limiter.acquire()
+            await chat_limiter.acquire()
+            try:
+                return await self.bot.send_message(**kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Лимит Telegram для чата {kwargs['chat_id']}: повтор через {e.retry_after} сек.")
+                await asyncio.sleep(e.retry_after)
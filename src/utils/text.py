@@ -0,0 +1,36 @@
+import re
+
+# Приблизительный токен: до 4 символов слова или один знак препинания (кириллица дробится BPE еще мельче)
+_TOKEN_RE = re.compile(r'\w{1,4}|[^\w\s]')
+
+# Вежливые вставки, не влияющие на смысл сообщения
+_FILLER_RE = re.compile(
+    r'\b(?:всем\s+привет|привет(?:ствую)?(?:\s+всем)?|добр(?:ый|ое|ого)\s+(?:день|вечер|утро|утра|дня|вечера)|'
+    r'здравствуйте|подскажите(?:,?\s+пожалуйста)?|заранее\s+спасибо)\b[\s,!.]*',
+    re.IGNORECASE
+)
+
+
+def strip_filler(text: str) -> str:
+    """Убирает из текста приветствия и вежливые вставки"""
+    stripped = _FILLER_RE.sub('', text).strip()
+    # Если сообщение состояло только из вежливости - оставляем как есть
+    return stripped or text.strip()
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст примерно до max_tokens токенов по границе слова"""
+    end = None
+    for count, match in enumerate(_TOKEN_RE.finditer(text), 1):
+        if count > max_tokens:
+            end = match.start()
+            break
+    if end is None:
+        return text
+
+    cut = text[:end]
+    # Не разрываем слово посередине, если в обрезке есть граница слова
+    boundary = cut.rfind(' ')
+    if boundary > 0 and text[end - 1:end + 1].isalnum():
+        cut = cut[:boundary]
+    return cut.rstrip() + "..."
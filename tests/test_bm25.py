@@ -0,0 +1,25 @@
+import unittest
+
+from src.utils.bm25 import BM25Index, stem_tokens
+
+
+class BM25Test(unittest.TestCase):
+    def test_stem_tokens(self):
+        self.assertEqual(stem_tokens("Деплоим сервисы в 2 этапа"), ['депло', 'серви', '2', 'этапа'])
+
+    def test_most_relevant_document_first(self):
+        index = BM25Index([
+            "Настройка мониторинга и алертов для продакшена",
+            "Деплой бота дайджеста на сервер",
+            "Обсуждение дизайна новых карточек",
+        ])
+        self.assertEqual(index.top("когда деплой бота?", 2), [1])
+        self.assertEqual(index.top("алерты мониторинга", 3)[0], 0)
+
+    def test_no_matches_and_empty_index(self):
+        self.assertEqual(BM25Index(["один документ"]).top("другое", 3), [])
+        self.assertEqual(BM25Index([]).top("что угодно", 3), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from src.db import Database
+
+
+class IterUnprocessedByTopicTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, 'test.db'))
+        self.addCleanup(self.db.close)
+        self.addCleanup(self.tmp.cleanup)
+
+    def save(self, message_id, topic_id, created_at):
+        self.db.save_message({'message_id': message_id, 'topic_id': topic_id, 'message_text': f'text {message_id}',
+                              'created_at': created_at})
+
+    def test_every_message_once_in_order_within_topic(self):
+        # Несколько сообщений с одинаковым created_at: порядок внутри секунды задает id
+        for message_id in range(1, 8):
+            self.save(message_id, 1, '2024-02-01 10:00:00' if message_id < 5 else '2024-02-01 10:00:01')
+        for message_id in range(10, 13):
+            self.save(message_id, None, '2024-02-01 09:00:00')
+
+        chunks = list(self.db.iter_unprocessed_by_topic(chunk_size=2))
+
+        self.assertTrue(all(len(rows) <= 2 for _, rows in chunks))
+        by_topic = {}
+        for topic_id, rows in chunks:
+            by_topic.setdefault(topic_id, []).extend(row['message_id'] for row in rows)
+        self.assertEqual(by_topic, {1: list(range(1, 8)), None: [10, 11, 12]})
+        # Топики идут один за другим, а не вперемешку
+        topic_order = [topic_id for topic_id, _ in chunks]
+        self.assertEqual(topic_order, sorted(topic_order, key=topic_order.index))
+
+    def test_messages_processed_during_iteration_are_not_repeated(self):
+        for message_id in range(1, 7):
+            self.save(message_id, 1, f'2024-02-01 10:00:0{message_id}')
+
+        seen = []
+        for _, rows in self.db.iter_unprocessed_by_topic(chunk_size=2):
+            seen.extend(row['message_id'] for row in rows)
+            # Результаты классификации записываются между порциями
+            self.db.update_message_threads_bulk([(row['message_id'], None, 'other') for row in rows])
+
+        self.assertEqual(seen, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.db.get_unprocessed_messages(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
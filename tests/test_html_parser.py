@@ -0,0 +1,41 @@
+import unittest
+from datetime import datetime
+
+from src.services.html_parser import _message_div_number, _parse_export_datetime
+
+
+class MessageDivNumberTest(unittest.TestCase):
+    def test_message_ids(self):
+        self.assertEqual(_message_div_number('message123'), 123)
+        self.assertEqual(_message_div_number('message-5'), 5)
+        self.assertEqual(_message_div_number('message0'), 0)
+
+    def test_not_message_ids(self):
+        for div_id in ('', 'message', 'message-', 'messages', 'message12a', 'message--1', 'message 1',
+                       'xmessage1', 'message١٢', 'message²'):
+            with self.subTest(div_id=div_id):
+                self.assertIsNone(_message_div_number(div_id))
+
+
+class ParseExportDatetimeTest(unittest.TestCase):
+    def test_matches_strptime(self):
+        for title in ('01.02.2024 10:00:00 UTC+03:00', '31.12.2023 23:59:59 UTC+03:00',
+                      '29.02.2024 00:00:00 UTC+03:00'):
+            with self.subTest(title=title):
+                self.assertEqual(_parse_export_datetime(title),
+                                 datetime.strptime(title, "%d.%m.%Y %H:%M:%S UTC+03:00"))
+
+    def test_result_is_naive(self):
+        self.assertIsNone(_parse_export_datetime('01.02.2024 10:00:00 UTC+03:00').tzinfo)
+
+    def test_bad_titles_raise_value_error(self):
+        for title in ('bad date', '', '01.02.2024 10:00:00 UTC+05:00', '1.02.2024 10:00:00 UTC+03:00',
+                      '01-02-2024 10:00:00 UTC+03:00', '31.02.2024 10:00:00 UTC+03:00',
+                      '01.02.2024 25:00:00 UTC+03:00', '0a.02.2024 10:00:00 UTC+03:00'):
+            with self.subTest(title=title):
+                with self.assertRaises(ValueError):
+                    _parse_export_datetime(title)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from src.utils.json_stream import JsonArrayStreamParser
+
+RESPONSE = json.dumps({
+    "results": [
+        {"message_index": 0, "classification": "goal", "title": "Бот {дайджеста} [v2]", "confidence": 0.9},
+        {"message_index": 1, "classification": "other", "title": "кавычки \" и \\ слеш", "confidence": 0.5},
+        {"message_index": 2, "classification": "blocker", "title": None, "confidence": 1},
+    ]
+}, ensure_ascii=False)
+
+
+def feed_all(parser: JsonArrayStreamParser, chunks):
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(chunk))
+    return items
+
+
+class JsonArrayStreamParserTest(unittest.TestCase):
+    def test_any_chunking_gives_same_items(self):
+        expected = json.loads(RESPONSE)['results']
+        for size in (1, 2, 3, 7, 64, len(RESPONSE)):
+            with self.subTest(size=size):
+                parser = JsonArrayStreamParser('results')
+                chunks = [RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)]
+                self.assertEqual(feed_all(parser, chunks), expected)
+                self.assertEqual(parser.items_seen, len(expected))
+                self.assertEqual(parser.text, RESPONSE)
+
+    def test_item_is_returned_as_soon_as_it_closes(self):
+        parser = JsonArrayStreamParser('results')
+        self.assertEqual(parser.feed('{"results": [{"a": 1}, {"b"'), [{"a": 1}])
+        self.assertEqual(parser.feed(': 2}'), [{"b": 2}])
+
+    def test_fenced_response_and_text_after_array(self):
+        parser = JsonArrayStreamParser('results')
+        items = feed_all(parser, ['```json\n{"results": [{"a": 1}]', ', "extra": [{"b": 2}]}\n```'])
+        self.assertEqual(items, [{"a": 1}])
+
+    def test_non_object_items_are_skipped(self):
+        parser = JsonArrayStreamParser('results')
+        self.assertEqual(parser.feed('{"results": [1, "x", {"a": 1}, null]}'), [{"a": 1}])
+
+    def test_missing_key_yields_nothing(self):
+        parser = JsonArrayStreamParser('results')
+        self.assertEqual(feed_all(parser, ['{"items": [{"a": 1}]}']), [])
+        self.assertEqual(parser.items_seen, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
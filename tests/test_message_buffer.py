@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+
+from src.services.message_buffer import MessageWriteBuffer
+
+
+class FakeDatabase:
+    """Database, у которого запись в пуле потоков завершается только по complete() (или сразу, если auto_complete)"""
+
+    def __init__(self, auto_complete: bool = False):
+        self.auto_complete = auto_complete
+        self.saved = []
+        self.pending = []
+
+    def save_messages(self, rows):
+        self.saved.extend(row['message_id'] for row in rows)
+        return len(rows)
+
+    def run(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, func, args))
+        if self.auto_complete:
+            self.complete()
+        return future
+
+    def complete(self):
+        # Отмененный future - задача, так и не взятая пулом
+        while self.pending:
+            future, func, args = self.pending.pop(0)
+            if not future.cancelled():
+                future.set_result(func(*args))
+
+
+class MessageWriteBufferTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_during_write_keeps_batch(self):
+        db = FakeDatabase()
+        buffer = MessageWriteBuffer(db, flush_interval=0)
+        task = asyncio.create_task(buffer.run())
+        for message_id in range(3):
+            buffer.add({'message_id': message_id})
+        while not db.pending:
+            await asyncio.sleep(0)
+
+        buffer.add({'message_id': 3})
+        task.cancel()
+        while not task.done():
+            await asyncio.sleep(0)
+            db.complete()
+
+        self.assertEqual(sorted(db.saved), [0, 1, 2, 3])
+
+    async def test_flush_during_batch_wait_writes_taken_rows(self):
+        db = FakeDatabase(auto_complete=True)
+        buffer = MessageWriteBuffer(db, flush_interval=10)
+        task = asyncio.create_task(buffer.run())
+        buffer.add({'message_id': 1})
+        # run забрал сообщение из очереди и ждет добора пачки
+        while not buffer._queue.empty():
+            await asyncio.sleep(0)
+
+        buffer.add({'message_id': 2})
+        await buffer.flush()
+        self.assertEqual(sorted(db.saved), [1, 2])
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(sorted(db.saved), [1, 2])
+
+    async def test_flush_waits_for_batch_being_written(self):
+        db = FakeDatabase()
+        buffer = MessageWriteBuffer(db, flush_interval=0)
+        task = asyncio.create_task(buffer.run())
+        buffer.add({'message_id': 1})
+        while not db.pending:
+            await asyncio.sleep(0)
+
+        flush = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0)
+        self.assertFalse(flush.done())
+        db.complete()
+        await flush
+        self.assertEqual(db.saved, [1])
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
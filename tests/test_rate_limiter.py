@@ -0,0 +1,35 @@
+import asyncio
+import time
+import unittest
+
+from src.utils.rate_limiter import TokenBucket
+
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_up_to_rate_without_waiting(self):
+        limiter = TokenBucket(rate=5, period=1.0)
+        started = time.monotonic()
+        for _ in range(5):
+            await limiter.acquire()
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    async def test_waits_for_refill_when_empty(self):
+        limiter = TokenBucket(rate=10, period=1.0)
+        for _ in range(10):
+            await limiter.acquire()
+        started = time.monotonic()
+        async with limiter:
+            pass
+        self.assertGreaterEqual(time.monotonic() - started, 0.08)
+
+    async def test_concurrent_acquires_are_spaced(self):
+        limiter = TokenBucket(rate=20, period=1.0)
+        for _ in range(20):
+            await limiter.acquire()
+        started = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(3)))
+        self.assertGreaterEqual(time.monotonic() - started, 0.14)
+
+
+if __name__ == '__main__':
+    unittest.main()
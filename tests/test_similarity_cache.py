@@ -0,0 +1,34 @@
+import unittest
+
+from src.services.similarity_cache import LexicalSimilarityCache
+
+BASE = "Закончили деплой сервиса уведомлений на прод, мониторинг и алерты настроены, логи собираются"
+
+
+class LexicalSimilarityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = LexicalSimilarityCache()
+        self.cache.add(BASE, {'classification': 'goal', 'title': 'Деплой уведомлений', 'confidence': 0.9})
+
+    def test_negated_text_is_not_matched(self):
+        self.assertIsNone(self.cache.lookup("Не " + BASE))
+
+    def test_different_number_is_not_matched(self):
+        self.cache.add("Релиз 12 выкатили на прод без проблем, откат не понадобился",
+                       {'classification': 'other', 'title': None, 'confidence': 0.8})
+        self.assertIsNone(self.cache.lookup("Релиз 13 выкатили на прод без проблем, откат не понадобился"))
+
+    def test_near_duplicate_reuses_classification_without_title(self):
+        result = self.cache.lookup("Всем привет! " + BASE)
+        self.assertEqual(result, {'classification': 'goal', 'confidence': 0.9, 'title': None})
+
+    def test_other_namespace_is_not_matched(self):
+        self.cache.add("Нужен стенд для нагрузочного тестирования платежного шлюза",
+                       {'classification': 'blocker', 'title': None, 'confidence': 0.8}, namespace='schema|model-a')
+        text = "Нужен стенд для нагрузочного тестирования платежного шлюза"
+        self.assertIsNone(self.cache.lookup(text, namespace='schema|model-b'))
+        self.assertEqual(self.cache.lookup(text, namespace='schema|model-a')['classification'], 'blocker')
+
+
+if __name__ == '__main__':
+    unittest.main()